@@ -0,0 +1,452 @@
+import bisect
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent import futures
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    AbstractSet,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+from urllib.parse import unquote, urlsplit
+
+from typing_extensions import Final
+
+if TYPE_CHECKING:
+    from proofaday.message import Filters
+    from proofaday.record import Record
+
+T = TypeVar("T")
+
+
+def normalize_title(name: str) -> str:
+    # Mirror MediaWiki's canonicalization so "foo_bar" and "Foo bar" coincide
+    title = " ".join(name.replace("_", " ").split())
+    return title[:1].upper() + title[1:]
+
+
+def url_title(url: str) -> str:
+    path = urlsplit(url).path
+    return normalize_title(unquote(path.rsplit("/wiki/", 1)[-1]))
+
+
+def save_records(file: Path, entries: Iterable[Tuple[str, "Record"]]) -> bool:
+    tmp = file.with_suffix(".tmp")
+    try:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with tmp.open("w", encoding="utf-8") as f:
+            for title, proof in entries:
+                f.write(json.dumps({"key": title, **proof.to_dict()}) + "\n")
+        os.replace(tmp, file)
+        return True
+    except OSError:
+        return False
+
+
+def load_records(
+    file: Path,
+    decode: Callable[[Dict[str, Any]], "Record"],
+) -> Iterator[Tuple[str, "Record"]]:
+    with file.open(encoding="utf-8") as f:
+        for line in f:
+            data = json.loads(line)
+            yield data["key"], decode(data)
+
+
+class SingleFlight(Generic[T]):
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls: Dict[str, "futures.Future[T]"] = {}
+
+    def do(self, key: str, f: Callable[[], T]) -> T:
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self.calls[key] = futures.Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = f()
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class NegativeCache:
+    max_entries: Final = 1024
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.expires: "OrderedDict[str, float]" = OrderedDict()
+
+    def add(self, key: str) -> None:
+        with self.lock:
+            self.expires.pop(key, None)
+            self.expires[key] = time.monotonic() + self.ttl
+            while len(self.expires) > NegativeCache.max_entries:
+                self.expires.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            expires = self.expires.get(key)
+            if expires is None:
+                return False
+            if expires <= time.monotonic():
+                del self.expires[key]
+                return False
+            return True
+
+
+class IndexedSet:
+    # A set with constant time sampling
+    def __init__(self) -> None:
+        self.items: List[str] = []
+        self.index: Dict[str, int] = {}
+
+    def add(self, item: str) -> None:
+        if item not in self.index:
+            self.index[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item: str) -> None:
+        idx = self.index.pop(item, None)
+        if idx is None:
+            return
+        last = self.items.pop()
+        if idx < len(self.items):
+            self.items[idx] = last
+            self.index[last] = idx
+
+    def choice(self) -> str:
+        return random.choice(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class ProofCache:
+    # Cached records drop their prerendered formats, so that a large cache
+    # holds little more than the text of each proof. They are indexed by
+    # category and length for filtered sampling. Entries are evicted in least
+    # recently used order once there are too many or they take too much
+    # memory, counting each record with its renders and index entries.
+    sample_tries: Final = 16
+    entry_overhead: Final = 288
+    index_overhead: Final = 80
+
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Signalled whenever proofs are added
+        self.added = threading.Condition(self.lock)
+        self.proofs: "OrderedDict[str, Record]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.keys: Dict[int, str] = {}
+        # Names that resolved to other titles, without copies of their proofs
+        self.aliases: "OrderedDict[str, str]" = OrderedDict()
+        self.nbytes = 0
+        # Whether there are changes to save
+        self.dirty = False
+        self.all = IndexedSet()
+        self.by_category: Dict[str, IndexedSet] = {}
+        self.by_lines: Dict[int, IndexedSet] = {}
+
+    @staticmethod
+    def entry_size(proof: "Record") -> int:
+        indexes = 2 + len(proof.categories)
+        overhead = ProofCache.entry_overhead + indexes * ProofCache.index_overhead
+        return proof.nbytes() + overhead
+
+    def _index(self, title: str, proof: "Record") -> None:
+        self.dirty = True
+        self.sizes[title] = ProofCache.entry_size(proof)
+        self.nbytes += self.sizes[title]
+        self.keys[id(proof)] = title
+        self.all.add(title)
+        for category in proof.categories:
+            self.by_category.setdefault(category, IndexedSet()).add(title)
+        self.by_lines.setdefault(proof.lines, IndexedSet()).add(title)
+
+    def _unindex(self, title: str, proof: "Record") -> None:
+        self.dirty = True
+        self.nbytes -= self.sizes.pop(title)
+        del self.keys[id(proof)]
+        self.all.discard(title)
+        for category in proof.categories:
+            self.by_category[category].discard(title)
+            if len(self.by_category[category]) == 0:
+                del self.by_category[category]
+        self.by_lines[proof.lines].discard(title)
+        if len(self.by_lines[proof.lines]) == 0:
+            del self.by_lines[proof.lines]
+
+    def _pop(self, title: str) -> None:
+        old = self.proofs.pop(title, None)
+        if old is not None:
+            self._unindex(title, old)
+
+    def _put(self, title: str, proof: "Record") -> None:
+        title = sys.intern(title)
+        proof = proof.compact()
+        self._pop(title)
+        # Don't flush the whole cache for a proof that can't fit anyway
+        size = ProofCache.entry_size(proof)
+        if self.max_bytes is None or size <= self.max_bytes:
+            self.proofs[title] = proof
+            self._index(title, proof)
+            self._evict()
+
+    def put(self, title: str, proof: "Record") -> None:
+        with self.lock:
+            self._put(title, proof)
+            self.added.notify_all()
+
+    def extend(self, entries: Iterable[Tuple[str, "Record"]]) -> None:
+        # Insert in bulk, under a single lock
+        with self.lock:
+            for title, proof in entries:
+                self._put(title, proof)
+            self.added.notify_all()
+
+    def wait(self, timeout: float) -> bool:
+        # Whether a proof was added in time
+        with self.lock:
+            return self.added.wait(timeout)
+
+    def _full(self) -> bool:
+        over = self.max_bytes is not None and self.nbytes > self.max_bytes
+        return len(self.proofs) > self.max_entries or over
+
+    def _evict(self) -> None:
+        while len(self.proofs) > 0 and self._full():
+            self._pop(next(iter(self.proofs)))
+
+    def resize(self, max_bytes: Optional[int]) -> None:
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def remeasure(self, proof: "Record") -> None:
+        # Cached records keep the renders made when they are served
+        with self.lock:
+            title = self.keys.get(id(proof))
+            if title is None or self.proofs.get(title) is not proof:
+                return
+            size = ProofCache.entry_size(proof)
+            self.nbytes += size - self.sizes[title]
+            self.sizes[title] = size
+            self._evict()
+
+    def alias(self, name: str, title: str) -> None:
+        if name == title:
+            return
+        with self.lock:
+            self.aliases.pop(name, None)
+            self.aliases[name] = title
+            while len(self.aliases) > self.max_entries:
+                self.aliases.popitem(last=False)
+
+    def get(self, title: str) -> Optional["Record"]:
+        with self.lock:
+            title = self.aliases.get(title, title)
+            proof = self.proofs.get(title)
+            if proof is not None:
+                self.proofs.move_to_end(title)
+            return proof
+
+    def peek(self, title: str) -> Optional["Record"]:
+        with self.lock:
+            return self.proofs.get(title)
+
+    def remove(self, title: str) -> None:
+        with self.lock:
+            self._pop(title)
+
+    def titles(self) -> List[str]:
+        with self.lock:
+            return list(self.proofs)
+
+    def random(self) -> Optional["Record"]:
+        with self.lock:
+            if len(self.all) == 0:
+                return None
+            return self.proofs[self.all.choice()]
+
+    def _draw_short(self, max_lines: int) -> Optional[str]:
+        # Pick a length bucket weighted by its size, then a title within it
+        buckets = [s for lines, s in self.by_lines.items() if lines <= max_lines]
+        total = sum(len(bucket) for bucket in buckets)
+        if total == 0:
+            return None
+        idx = random.randrange(total)
+        for bucket in buckets:
+            if idx < len(bucket):
+                return bucket.items[idx]
+            idx -= len(bucket)
+        return None
+
+    def sample(
+        self,
+        filters: "Filters",
+        exclude: AbstractSet[str] = frozenset(),
+    ) -> Optional["Record"]:
+        def matches(title: str) -> bool:
+            proof = self.proofs[title]
+            if filters.max_lines is not None and proof.lines > filters.max_lines:
+                return False
+            return title not in exclude
+
+        with self.lock:
+            if filters.category is not None:
+                pool = self.by_category.get(normalize_title(filters.category))
+            else:
+                pool = self.all
+            if pool is None or len(pool) == 0:
+                return None
+            # Sample from the most selective index, checking the rest
+            for _ in range(ProofCache.sample_tries):
+                if filters.category is None and filters.max_lines is not None:
+                    title = self._draw_short(filters.max_lines)
+                    if title is None:
+                        return None
+                else:
+                    title = pool.choice()
+                if matches(title):
+                    return self.proofs[title]
+            # Mostly excluded, fall back to a scan
+            candidates = [title for title in pool.items if matches(title)]
+            if len(candidates) == 0:
+                return None
+            return self.proofs[random.choice(candidates)]
+
+    def __len__(self) -> int:
+        return len(self.proofs)
+
+    def save(self, file: Path) -> bool:
+        with self.lock:
+            if not self.dirty:
+                return True
+            entries = list(self.proofs.items())
+            self.dirty = False
+        if not save_records(file, entries):
+            self.dirty = True
+            return False
+        return True
+
+    def load(self, file: Path, decode: Callable[[Dict[str, Any]], "Record"]) -> None:
+        try:
+            self.extend(load_records(file, decode))
+        except (OSError, ValueError, KeyError):
+            pass
+        # What was just loaded is already saved
+        self.dirty = False
+
+
+class RecentTitles:
+    # The titles most recently delivered to each client
+    max_clients: Final = 1024
+
+    def __init__(self, window: int) -> None:
+        self.window = window
+        self.lock = threading.Lock()
+        self.clients: "OrderedDict[str, Deque[str]]" = OrderedDict()
+
+    def add(self, client: str, title: str) -> None:
+        with self.lock:
+            recent = self.clients.pop(client, None)
+            if recent is None:
+                recent = deque(maxlen=self.window)
+            recent.append(title)
+            self.clients[client] = recent
+            while len(self.clients) > RecentTitles.max_clients:
+                self.clients.popitem(last=False)
+
+    def get(self, client: str) -> Set[str]:
+        with self.lock:
+            return set(self.clients.get(client, ()))
+
+
+# A persistent set of titles, stored compactly as sorted 64-bit hashes
+class SkipList:
+    magic: Final = b"PADSKIP1"
+    save_every: Final = 32
+
+    def __init__(self, file: Path) -> None:
+        self.file = file
+        self.lock = threading.Lock()
+        self.hashes = array("Q")
+        self.unsaved = 0
+        try:
+            data = file.read_bytes()
+            if data[: len(SkipList.magic)] == SkipList.magic:
+                self.hashes.frombytes(data[len(SkipList.magic) :])
+        except (OSError, ValueError):
+            self.hashes = array("Q")
+
+    @staticmethod
+    def hash(title: str) -> int:
+        digest = hashlib.blake2b(title.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def add(self, title: str) -> None:
+        h = SkipList.hash(title)
+        with self.lock:
+            idx = bisect.bisect_left(self.hashes, h)
+            if idx < len(self.hashes) and self.hashes[idx] == h:
+                return
+            self.hashes.insert(idx, h)
+            self.unsaved += 1
+            if self.unsaved >= SkipList.save_every:
+                self._save()
+
+    def __contains__(self, title: str) -> bool:
+        h = SkipList.hash(title)
+        with self.lock:
+            idx = bisect.bisect_left(self.hashes, h)
+            return idx < len(self.hashes) and self.hashes[idx] == h
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def _save(self) -> bool:
+        tmp = self.file.with_suffix(".tmp")
+        try:
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(SkipList.magic + self.hashes.tobytes())
+            os.replace(tmp, self.file)
+            self.unsaved = 0
+            return True
+        except OSError:
+            return False
+
+    def save(self) -> bool:
+        with self.lock:
+            return self.unsaved == 0 or self._save()
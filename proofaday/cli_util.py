@@ -1,7 +1,9 @@
+import re
 from pathlib import Path
 from typing import Optional
 
 import click
+from typing_extensions import Final
 
 
 class ClickPath(click.Path):
@@ -12,3 +14,16 @@ class ClickPath(click.Path):
         ctx: Optional[click.core.Context],
     ) -> Path:
         return Path(super().convert(value, param, ctx))
+
+
+SIZE: Final = re.compile(r"(\d+)\s*([kmg]?)i?b?", re.IGNORECASE)
+UNITS: Final = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def byte_size(value: object) -> int:
+    # A number of bytes, with an optional K, M or G suffix
+    match = SIZE.fullmatch(str(value).strip())
+    if match is None:
+        raise ValueError(f"{value!r} is not a size such as 512K or 64M.")
+    number, unit = match.groups()
+    return int(number) * UNITS[unit.lower()]
@@ -0,0 +1,66 @@
+import zlib
+from enum import IntEnum
+from typing import Callable, Dict, Tuple, Union
+
+Buffer = Union[bytes, memoryview]
+
+
+class Codec(IntEnum):
+    NONE = 0
+    ZLIB = 1
+    ZSTD = 2
+
+
+COMPRESS: Dict[Codec, Callable[[bytes], bytes]] = {
+    Codec.NONE: lambda data: data,
+    Codec.ZLIB: lambda data: zlib.compress(data, 9),
+}
+DECOMPRESS: Dict[Codec, Callable[[Buffer], Buffer]] = {
+    Codec.NONE: lambda data: data,
+    Codec.ZLIB: zlib.decompress,
+}
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    # N.B. zstandard (de)compressors must not be shared between threads
+    COMPRESS[Codec.ZSTD] = lambda data: zstandard.ZstdCompressor(19).compress(data)
+    DECOMPRESS[Codec.ZSTD] = lambda data: zstandard.ZstdDecompressor().decompress(
+        data,
+    )
+
+
+def best() -> Codec:
+    return max(COMPRESS)
+
+
+def negotiate(codec: Codec) -> Codec:
+    # Every client that can compress understands zlib
+    return codec if codec in COMPRESS else Codec.ZLIB
+
+
+def compress(data: bytes, codec: Codec) -> Tuple[Codec, bytes]:
+    # Payloads are left uncompressed if compression doesn't help
+    packed = COMPRESS[codec](data)
+    if len(packed) >= len(data):
+        return Codec.NONE, data
+    return codec, packed
+
+
+def pack(data: bytes, codec: Codec) -> Tuple[Codec, bytes]:
+    # Compress with the best codec the client accepts, if any
+    if codec is Codec.NONE:
+        return codec, data
+    return compress(data, negotiate(codec))
+
+
+def decompress(data: Buffer, codec: Codec) -> Buffer:
+    return DECOMPRESS[codec](data)
+
+
+def untag(data: Buffer) -> Buffer:
+    # Legacy compressed replies are tagged with their codec
+    if len(data) == 0:
+        return data
+    return decompress(data[1:], Codec(data[0]))
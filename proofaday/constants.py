@@ -1,16 +1,33 @@
-from platformdirs import user_log_dir, user_runtime_dir
+from platformdirs import user_cache_dir, user_log_dir, user_runtime_dir
 from typing_extensions import Final
 
 URL: Final = "https://proofwiki.org/wiki/"
+API_URL: Final = "https://proofwiki.org/w/api.php"
+INDEX_URL: Final = "https://proofwiki.org/w/index.php"
 RANDOM: Final = "Special:Random"
 
 NPREFETCH: Final = 10
+NCACHE: Final = 100
 LOG_PATH: Final = user_log_dir("proofaday")
 DATA_PATH: Final = user_runtime_dir("proofaday")
+CACHE_PATH: Final = user_cache_dir("proofaday")
+# Shared daemons keep their files where only root can create them
+SHARED_DATA_PATH: Final = "/run/proofaday"
+SHARED_CACHE_PATH: Final = "/var/cache/proofaday"
 LOG_FILE: Final = "proofaday.log"
 STATUS_FILE: Final = ".proofaday.status"
+SKIP_FILE: Final = "skip.bin"
+PROOF_CACHE_FILE: Final = "proofs.jsonl"
+QUEUE_FILE: Final = "queue.jsonl"
+CLIENT_CACHE_FILE: Final = "client.json"
+RING_FILE: Final = "ring.bin"
 
 HOST: Final = "localhost"
 PORT: Final = 48484
 
 CLIENT_TIMEOUT: Final = 3
+NCLIENT_CACHE: Final = 50
+ENDPOINT_VAR: Final = "PROOFADAY_ENDPOINT"
+# Sockets passed by systemd socket activation start at this fd
+LISTEN_FDS_START: Final = 3
+LAUNCH_IDLE_TIMEOUT: Final = 10 * 60
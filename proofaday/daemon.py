@@ -1,14 +1,27 @@
 import logging
 import os
+import random
 import signal
+import socket
 import socketserver
 import sys
 import threading
+import time
+from collections import Counter, deque
 from concurrent import futures
-from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from queue import Queue
-from typing import TYPE_CHECKING, Any, NoReturn, Optional, Set, cast
+from queue import Empty
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    cast,
+)
 
 import requests
 from bs4 import BeautifulSoup as BS
@@ -17,16 +30,47 @@ from requests import exceptions as exs
 from typing_extensions import Final
 
 import proofaday.constants as consts
-from proofaday.message import Action, Message
-from proofaday.proof import InvalidProofException, Proof
-from proofaday.status import Status
+from proofaday import log, wiki
+from proofaday.cache import (
+    NegativeCache,
+    ProofCache,
+    RecentTitles,
+    SingleFlight,
+    SkipList,
+    load_records,
+    normalize_title,
+    save_records,
+    url_title,
+)
+from proofaday.codec import Buffer, pack
+from proofaday.message import (
+    Action,
+    Code,
+    Filters,
+    Format,
+    Message,
+    MessageError,
+    parse_random,
+)
+from proofaday.proof import (
+    InvalidProofException,
+    PreScan,
+    Proof,
+    ProofTooLongException,
+    UnsupportedMarkupException,
+    WikitextProof,
+)
+from proofaday.record import Record, head
+from proofaday.ring import ProofRing
+from proofaday.scheduler import FairQueue, Scheduler
+from proofaday.status import Status, shared_dir
+from proofaday.syms import latex_to_text
+from proofaday.wiki import Source
 
 if TYPE_CHECKING:
     # pylint: disable=unsubscriptable-object
-    StrQueue = Queue[str]
-    ProofFuture = futures.Future[Optional[str]]
+    ProofFuture = futures.Future[Optional[Record]]
 else:
-    StrQueue = Queue
     ProofFuture = futures.Future
 
 
@@ -34,51 +78,285 @@ class ServerError(Exception):
     pass
 
 
+class FetchError(Exception):
+    def __init__(self, code: Code) -> None:
+        super().__init__(code.name)
+        self.code = code
+
+
+class ReplyStream:
+    # Sends a reply to a request that has to be fetched in numbered parts:
+    # the text up to the proof as soon as it is known, then the proof in
+    # chunks. Only pages fetched as HTML are read far enough ahead to send
+    # the theorem first. Empty parts keep the client waiting until then. Once the last
+    # part is sent, anything a slower duplicate fetch writes is dropped.
+    part_size: Final = 4096
+    keepalive: Final = 0.5
+
+    def __init__(self, msg: Message, send: Callable[[List[Buffer]], None]) -> None:
+        self.msg = msg
+        self.send = send
+        self.nparts = 0
+        self.sent_head = False
+        self.sent_time = time.monotonic()
+        self.finished = False
+        self.lock = threading.RLock()
+        threading.Thread(
+            target=self.keep_alive,
+            daemon=True,
+            name="KeepAlive",
+        ).start()
+
+    def write(self, text: str, last: bool = False, is_head: bool = False) -> None:
+        with self.lock:
+            if self.finished:
+                return
+            method, payload = pack(text.encode(), self.msg.codec)
+            parts = self.msg.reply_parts(Code.OK, payload, method, self.nparts, last)
+            self.send(parts)
+            self.nparts += 1
+            self.sent_time = time.monotonic()
+            self.sent_head = self.sent_head or is_head
+            self.finished = last
+
+    def keep_alive(self) -> None:
+        while not self.finished:
+            time.sleep(ReplyStream.keepalive)
+            idle = time.monotonic() - self.sent_time
+            if idle >= ReplyStream.keepalive:
+                self.write("")
+
+    def close(self) -> None:
+        with self.lock:
+            self.finished = True
+
+    def head(self, title: str, raw_theorem: str) -> None:
+        fmt = self.msg.fmt
+        if fmt is Format.JSON:
+            return
+        theorem = raw_theorem if fmt is Format.LATEX else latex_to_text(raw_theorem)
+        self.write(head(fmt, title, theorem), is_head=True)
+
+    def finish(self, proof: Record) -> None:
+        with self.lock:
+            if self.finished:
+                return
+            if not self.sent_head:
+                # Nothing of the proof has been sent, so send its stored
+                # render as it is
+                codec, payload = proof.render(self.msg.fmt, self.msg.codec)
+                self.send(
+                    self.msg.reply_parts(Code.OK, payload, codec, self.nparts),
+                )
+                self.finished = True
+                return
+            parts = proof.parts(self.msg.fmt, ReplyStream.part_size)[1:]
+            if len(parts) == 0:
+                parts = [""]
+            for idx, text in enumerate(parts):
+                self.write(text, last=idx == len(parts) - 1)
+
+
+def listen_socket(fd: int) -> socket.socket:
+    # Addresses are only decoded correctly for the kind of socket the daemon
+    # would bind itself
+    try:
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_DGRAM)
+        os.close(fd)
+    except OSError as e:
+        raise ServerError(f"Can't use file descriptor {fd}: {e}") from e
+    kind = sock.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+    # N.B. SO_DOMAIN is Linux only
+    domain = getattr(socket, "SO_DOMAIN", None)
+    family = sock.getsockopt(socket.SOL_SOCKET, domain) if domain else None
+    if kind != socket.SOCK_DGRAM or family not in (None, socket.AF_INET):
+        sock.close()
+        raise ServerError("Only IPv4 UDP sockets can be served on.")
+    return sock
+
+
 class ProofHandler(socketserver.BaseRequestHandler):
+    def send(self, parts: List[Buffer]) -> None:
+        _, sock = self.request
+        sock.sendmsg(parts, [], 0, self.client_address)
+
     def handle(self) -> None:
-        data, sock = self.request
-        msg = Message.decode(data)
+        start = time.perf_counter()
+        data, _ = self.request
         server: ProofServer = cast(ProofServer, self.server)
+        server.last_request = time.monotonic()
         logger = server.logger
+        try:
+            msg = Message.decode(data)
+            client, filters = "", Filters()
+            if msg.action is Action.RANDOM:
+                client, filters = parse_random(msg.data)
+        except (MessageError, ValueError) as e:
+            logger.info("Malformed message from (%s, %d): %s", *self.client_address, e)
+            return
         logger.info("Received %s from (%s, %d)", msg.action, *self.client_address)
 
-        if msg.action is Action.REQUEST:
-            logger.info("Fetching %s", msg.data)
-            proof = server.fetch_proof(msg.data)
-            reply = proof if proof is not None else ""
-        elif msg.action is Action.RANDOM:
-            logger.info("Dequeuing proof")
-            reply = server.queue.get()
-        sock.sendto(reply.encode(), self.client_address)
+        stream = None
+        try:
+            if msg.action is Action.REQUEST:
+                logger.info("Fetching %s", msg.data)
+                proof = server.known_proof(msg.data)
+                if proof is None:
+                    # Only a fetch is slow enough to be worth streaming
+                    if msg.stream:
+                        stream = ReplyStream(msg, self.send)
+                    proof = server.request_proof(msg.data, stream)
+            elif msg.action is Action.RANDOM:
+                logger.info("Dequeuing proof")
+                # Clients identify themselves so that they can be served fairly
+                client = client or self.client_address[0]
+                proof = server.random_proof(client, filters)
+                server.recent.add(client, proof.title)
+            code, title = Code.OK, proof.title
+            if stream is not None:
+                stream.finish(proof)
+            else:
+                codec, payload = proof.render(msg.fmt, msg.codec)
+                # Send the stored render without copying it into a new reply
+                self.send(msg.reply_parts(code, payload, codec))
+            server.cache.remeasure(proof)
+        except FetchError as e:
+            code, title = e.code, None
+            self.send(msg.reply_parts(code))
+        finally:
+            if stream is not None:
+                stream.close()
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(
+            "Replied %s in %.2fms",
+            code.name,
+            elapsed,
+            extra={
+                "action": msg.action.name,
+                "client": client or self.client_address[0],
+                "title": title,
+                "code": code.name,
+                "elapsed_ms": elapsed,
+            },
+        )
 
 
 class ProofServer(socketserver.ThreadingUDPServer):
     daemon_threads = True
-    proof_timeout: Final = 1
-    max_log_bytes: Final = 1024 * 1024
+    queue_poll: Final = 1
     max_threads: Final = 5
+    miss_ttl: Final = 60
+    status_interval: Final = 1
+    chunk_size: Final = 16 * 1024
+    refresh_interval: Final = 60 * 60
+    refresh_batch: Final = 50
+    random_batch: Final = 10
+    recent_window: Final = 100
+    filter_wait: Final = 1.5
+    hedge_threads: Final = 10
+    # The part of the memory budget the prefetch queue may take, the cache
+    # gets the rest
+    queue_share: Final = 0.5
+    # The part of the queue's share the ring may take
+    ring_share: Final = 0.5
+    # How often to check for a shutdown, how long to let in-flight fetches
+    # finish, and when to give up on a clean exit
+    stop_poll: Final = 0.05
+    shutdown_grace: Final = 0.25
+    shutdown_timeout: Final = 2.0
+    ring_slot_size: Final = 64 * 1024
+    ring_poll: Final = 0.25
+    ring_client: Final = "\0ring"
 
     def __init__(
         self,
         port: int,
         line_limit: int,
         nprefetch: int,
+        ncache: int,
         debug: int,
         log_path: Path,
+        log_format: str,
+        cache_path: Path,
+        source: Source,
         status: Status,
+        warm_cache: bool = False,
+        ring: bool = False,
+        listen_fd: Optional[int] = None,
+        idle_timeout: float = 0,
+        max_memory: Optional[int] = None,
     ) -> None:
         self.status = status
+        # Other users must not be able to plant files where a shared daemon
+        # writes, or that its clients read
+        if status.shared and not all(
+            shared_dir(path) for path in (status.file.parent, cache_path)
+        ):
+            raise ServerError(
+                "Shared directories must belong to root or this user and not"
+                " be writable by others."
+            )
         if not self.status.touch():
             raise ServerError("Status file already exists or couldn't be created.")
 
-        super().__init__((consts.HOST, port), ProofHandler)
+        super().__init__(
+            (consts.HOST, port),
+            ProofHandler,
+            bind_and_activate=listen_fd is None,
+        )
+        if listen_fd is not None:
+            # Serve on a socket bound by whoever started the daemon
+            self.socket.close()
+            try:
+                self.socket = listen_socket(listen_fd)
+            except ServerError:
+                self.status.remove()
+                raise
+            self.server_address = self.socket.getsockname()
+        self.idle_timeout = idle_timeout
+        self.last_request = time.monotonic()
+        self.stop_event = threading.Event()
+        self.deadline: Optional[threading.Timer] = None
+        self.jobs: Set[ProofFuture] = set()
         level = {0: logging.NOTSET, 1: logging.INFO}.get(debug, logging.DEBUG)
-        self.logger = self.init_logger(level, log_path)
-        self.queue: StrQueue = Queue(maxsize=nprefetch)
+        self.logger, self.log_listener = log.init_logger(
+            __name__,
+            level,
+            log_path,
+            structured=log_format == "json",
+        )
+        self.max_memory = max_memory
+        self.queue: FairQueue[Record] = FairQueue(nprefetch, Record.nbytes)
         self.limit = line_limit if line_limit > 0 else None
+        self.inflight: SingleFlight[Record] = SingleFlight()
+        self.hedge_pool = futures.ThreadPoolExecutor(
+            max_workers=ProofServer.hedge_threads,
+            thread_name_prefix="Hedge",
+        )
+        self.misses = NegativeCache(ProofServer.miss_ttl)
+        self.cache = ProofCache(ncache, max_memory)
+        self.recent = RecentTitles(ProofServer.recent_window)
+        self.cache_file = cache_path / consts.PROOF_CACHE_FILE
+        self.queue_file = cache_path / consts.QUEUE_FILE
+        self.cache.load(self.cache_file, Record.from_dict)
+        self.scheduler = Scheduler()
+        self.source = source
+        self.random_pages: Deque[wiki.Page] = deque()
+        self.random_lock = threading.Lock()
+        self.skip = SkipList(cache_path / consts.SKIP_FILE)
+        self.stats: "Counter[str]" = Counter()
+        self.stats_lock = threading.Lock()
+        self.status_lock = threading.Lock()
+        self.status_time = 0.0
+        self.closed = False
+        self.ring = self.create_ring() if ring and not status.shared else None
+        self.rebalance()
 
-        host, port = self.server_address
-        if not self.status.write(pid=os.getpid(), host=host, port=port):
+        # Clients only find the daemon once the status is written
+        self.logger.info("Restored %d queued proofs", self.restore_queue())
+        if warm_cache:
+            self.logger.info("Warmed %d proofs from the cache", self.warm_from_cache())
+        if not self.write_status():
             self.status.remove()
             raise ServerError("Failed to write status file.")
 
@@ -87,83 +365,598 @@ class ProofServer(socketserver.ThreadingUDPServer):
             daemon=True,
             name="ServerLoop",
         ).start()
+        threading.Thread(
+            target=self.refresh_proofs,
+            daemon=True,
+            name="Refresher",
+        ).start()
+        if self.ring is not None:
+            threading.Thread(
+                target=self.feed_ring,
+                daemon=True,
+                name="RingFeeder",
+            ).start()
 
-    @staticmethod
-    def init_logger(level: int, path: Path) -> logging.Logger:
-        logger = logging.getLogger(__name__)
-        logger.setLevel(level)
-        if level != logging.NOTSET:
-            path.mkdir(parents=True, exist_ok=True)
-            handler: logging.Handler = RotatingFileHandler(
-                path / consts.LOG_FILE,
-                maxBytes=ProofServer.max_log_bytes,
-                backupCount=1,
-                encoding="utf8",
+    def write_status(self) -> bool:
+        host, port = self.server_address
+        with self.stats_lock:
+            stats = dict(self.stats)
+        with self.status_lock:
+            if self.closed:
+                return False
+            self.status_time = time.monotonic()
+            # Proofs published to the ring are still waiting to be read
+            queued, capacity = self.queue.qsize(), self.queue.maxsize
+            if self.ring is not None:
+                queued += self.ring.count()
+                capacity += self.ring.nslots
+            return self.status.write(
+                pid=os.getpid(),
+                host=host,
+                port=port,
+                ready=queued > 0,
+                queued=queued,
+                capacity=capacity,
+                fetched=stats.get("fetched", 0),
+                rejected=stats.get("rejected", 0),
+                skipped=stats.get("skipped", 0),
+                hedges=stats.get("hedges", 0),
+                hedge_wins=stats.get("hedge_wins", 0),
+                hedge_losses=stats.get("hedge_losses", 0),
+                memory=self.memory(),
+                max_memory=self.max_memory or 0,
             )
-        else:
-            handler = logging.NullHandler()
-        handler.setFormatter(logging.Formatter("%(threadName)s: %(message)s"))
-        logger.addHandler(handler)
-        return logger
 
-    def server_close(self) -> None:
-        super().server_close()
+    def service_actions(self) -> None:
+        # Exit once no requests have come in for a while
+        idle = time.monotonic() - self.last_request
+        if 0 < self.idle_timeout <= idle and not self.stop_event.is_set():
+            self.logger.info("Idle for %.0fs, exiting", idle)
+            self.stop()
+
+    def stop(self) -> None:
+        # Have fetches give up at their next chance, and exit even if some
+        # can't
+        self.stop_event.set()
+        # N.B. shutdown() must be called in a separate thread
+        threading.Thread(target=self.shutdown).start()
+        self.deadline = threading.Timer(ProofServer.shutdown_timeout, self.abort)
+        self.deadline.daemon = True
+        self.deadline.start()
+
+    def abort(self) -> None:
+        self.logger.info("Shutdown timed out, exiting")
+        with self.status_lock:
+            self.closed = True
+            self.remove_files()
+        os._exit(1)  # pylint: disable=protected-access
+
+    def remove_files(self) -> None:
         status = self.status.read()
         if status is not None and status["pid"] == os.getpid():
             self.status.remove()
+        if self.ring is not None:
+            self.ring.remove()
+
+    def update_status(self) -> None:
+        if time.monotonic() - self.status_time >= ProofServer.status_interval:
+            self.rebalance()
+            self.write_status()
+
+    def ring_bytes(self) -> int:
+        if self.ring is None:
+            return 0
+        return ProofRing.size(self.ring.nslots, self.ring.slot_size)
+
+    def memory(self) -> int:
+        return self.queue.nbytes + self.cache.nbytes + self.ring_bytes()
+
+    def over_budget(self, nbytes: Optional[int] = None) -> bool:
+        # Whether the queue's share of the memory budget can't take a proof of
+        # this size, or of the average queued size
+        if self.max_memory is None:
+            return False
+        if nbytes is None:
+            nbytes = self.queue.nbytes // max(1, self.queue.qsize())
+        share = self.max_memory * ProofServer.queue_share - self.ring_bytes()
+        return self.queue.nbytes + nbytes > share
+
+    def rebalance(self) -> None:
+        # Let the cache use whatever the queue and ring leave of the budget
+        if self.max_memory is not None:
+            spare = self.max_memory - self.queue.nbytes - self.ring_bytes()
+            self.cache.resize(max(0, spare))
+
+    def count(self, stat: str) -> None:
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def server_close(self) -> None:
+        self.stop_event.set()
+        super().server_close()
+        # Fetched proofs are cached, so keep those that finish in time
+        futures.wait(self.jobs, timeout=ProofServer.shutdown_grace)
+        self.hedge_pool.shutdown(wait=False)
+        self.save_queue()
+        self.skip.save()
+        self.cache.save(self.cache_file)
+        with self.status_lock:
+            self.closed = True
+            self.remove_files()
+        if self.log_listener is not None:
+            self.log_listener.stop()
+        if self.deadline is not None:
+            self.deadline.cancel()
 
-    def fetch_proof(self, name: str = consts.RANDOM) -> Optional[str]:
-        url = consts.URL + name
+    def save_queue(self) -> None:
+        # Prefetched proofs nobody has seen yet are served first next time
+        proofs = self.queue.drain()
+        if len(proofs) > 0:
+            save_records(self.queue_file, [(proof.title, proof) for proof in proofs])
 
+    def restore_queue(self) -> int:
         try:
-            data = requests.get(url, timeout=ProofServer.proof_timeout).text
-            html = BS(data, "html.parser")
-            proof = Proof(html)
-            self.logger.debug(repr(proof))
-            return str(proof)
-        except (ConnectionResetError, exs.Timeout):
+            for _, proof in load_records(self.queue_file, Record.from_dict):
+                if self.queue.qsize() >= self.queue.maxsize:
+                    break
+                if self.within_limit(proof) and not self.over_budget(proof.nbytes()):
+                    self.queue.put(proof)
+        except (OSError, ValueError, KeyError):
+            pass
+        try:
+            self.queue_file.unlink()
+        except OSError:
             pass
+        self.rebalance()
+        return self.queue.qsize()
+
+    def fetch_proof(self, name: str = consts.RANDOM) -> Optional[Record]:
+        if self.stop_event.is_set():
+            return None
+        try:
+            return self.try_fetch_proof(name)
+        except FetchError:
+            return None
+
+    def try_fetch_proof(
+        self,
+        name: str,
+        stream: Optional[ReplyStream] = None,
+    ) -> Record:
+        url = consts.URL + name.replace(" ", "_")
+        title = normalize_title(name)
+        revision = None
+        categories: Tuple[str, ...] = ()
+        fetched = False
+
+        if name == consts.RANDOM:
+            self.scheduler.acquire()
+        elif not self.scheduler.allow():
+            self.logger.info("ProofWiki unavailable, not fetching %s", name)
+            raise FetchError(Code.UNAVAILABLE)
+
+        try:
+            if self.source is not Source.HTML:
+                start = time.monotonic()
+                page = self.resolve(name)
+                title, revision, content = page.title, page.revision, page.content
+                categories = page.categories
+                self.check_skip(name, title)
+                if content is not None:
+                    self.scheduler.success(time.monotonic() - start)
+                    if name == consts.RANDOM:
+                        self.count("fetched")
+                        fetched = True
+                    try:
+                        proof: Proof = WikitextProof(content, title)
+                        return self.parse_proof(title, proof, revision)
+                    except UnsupportedMarkupException as e:
+                        self.logger.info("Parsing %s from HTML instead: %s", title, e)
+                        categories = WikitextProof.page_categories(content)
+                url = wiki.render_url(title)
+            with requests.get(
+                url,
+                timeout=self.scheduler.timeout,
+                stream=True,
+            ) as resp:
+                if resp.status_code >= 500 or resp.status_code == 429:
+                    self.scheduler.failure()
+                else:
+                    self.scheduler.success(resp.elapsed.total_seconds())
+                resp.raise_for_status()
+                if name == consts.RANDOM and not fetched:
+                    self.count("fetched")
+                if self.source is Source.HTML:
+                    title = url_title(resp.url)
+                    self.check_skip(name, title)
+                scan = PreScan(self.limit if name == consts.RANDOM else None)
+                previewed = False
+                for chunk in resp.iter_content(ProofServer.chunk_size):
+                    if self.stop_event.is_set():
+                        raise FetchError(Code.UNAVAILABLE)
+                    done = scan.feed(chunk)
+                    if stream is not None and not previewed:
+                        previewed = self.preview(scan, title, stream)
+                    if done:
+                        break
+                else:
+                    scan.check()
+                data = scan.data.decode(resp.encoding or "utf-8", errors="replace")
+            html = BS(data, "html.parser")
+            proof = Proof(html, title, scan.categories() or categories)
+            return self.parse_proof(title, proof, scan.revision() or revision)
+        except FetchError:
+            raise
+        except (ConnectionResetError, exs.ConnectionError, exs.Timeout) as e:
+            self.logger.info("Failed to reach ProofWiki: %s", e)
+            self.scheduler.failure()
+            raise FetchError(Code.UNAVAILABLE) from e
+        except exs.HTTPError as e:
+            self.logger.info("HTTP error: %s", e)
+            if e.response is not None and e.response.status_code == 404:
+                self.reject(name)
+                raise FetchError(Code.NOT_FOUND) from e
+            raise FetchError(Code.UNAVAILABLE) from e
+        except ProofTooLongException as e:
+            self.logger.info("Proof too long: %s", e)
+            self.reject(name)
+            raise FetchError(Code.NOT_FOUND) from e
         except InvalidProofException as e:
-            self.logger.exception("Invalid proof: %s", str(e))
+            self.logger.exception("Invalid proof: %s", e)
+            self.skip.add(title)
+            self.reject(name)
+            raise FetchError(Code.NOT_FOUND) from e
         except Exception as e:  # pylint: disable=broad-except
             self.logger.exception(
                 "Unexpected exception while fetching a proof: %s",
-                str(e),
+                e,
             )
-        return None
+            raise FetchError(Code.ERROR) from e
 
-    def enqueue_proof(self, proof: str) -> None:
-        if self.limit is None or len(proof.split("\n")) <= self.limit:
+    @staticmethod
+    def preview(scan: PreScan, title: str, stream: ReplyStream) -> bool:
+        # Pass on the theorem once the page has been read up to the proof
+        # heading, returning whether there is nothing more to do
+        start = scan.found.get("proof")
+        if start is None:
+            return False
+        end = scan.data.find(b">", start)
+        if end == -1:
+            return False
+        data = scan.data[: end + 1].decode("utf-8", errors="replace")
+        try:
+            stream.head(*Proof.preview(BS(data, "html.parser"), title))
+        except InvalidProofException:
+            pass
+        return True
+
+    def parse_proof(
+        self,
+        title: str,
+        proof: Proof,
+        revision: Optional[int],
+    ) -> Record:
+        self.logger.debug("%r", proof)
+        record = Record.from_proof(proof, revision)
+        self.cache.put(title, record)
+        return record
+
+    def resolve(self, name: str) -> wiki.Page:
+        content = self.source is Source.WIKITEXT
+        if name != consts.RANDOM:
+            page = wiki.resolve(name, self.scheduler.timeout, content)
+            if page is None:
+                self.reject(name)
+                raise FetchError(Code.NOT_FOUND)
+            return page
+        # Random titles are fetched in batches, one API request for several
+        # proofs
+        with self.random_lock:
+            if len(self.random_pages) == 0:
+                self.random_pages.extend(
+                    wiki.random_pages(
+                        ProofServer.random_batch,
+                        self.scheduler.timeout,
+                        content,
+                    ),
+                )
+            return self.random_pages.popleft()
+
+    def check_skip(self, name: str, title: str) -> None:
+        # Only random proofs skip pages that failed to parse before, a named
+        # page is always tried again once its miss expires
+        if name == consts.RANDOM and title in self.skip:
+            # Counted apart from rejections, since the page isn't fetched
+            self.logger.info("Skipping known non-proof %s", title)
+            self.count("skipped")
+            raise FetchError(Code.NOT_FOUND)
+
+    def reject(self, name: str) -> None:
+        if name == consts.RANDOM:
+            self.count("rejected")
+        else:
+            self.misses.add(normalize_title(name))
+
+    def known_proof(self, name: str) -> Optional[Record]:
+        # Answer without fetching if possible
+        title = normalize_title(name)
+        if title in self.misses:
+            self.logger.info("Skipping known non-proof %s", title)
+            raise FetchError(Code.NOT_FOUND)
+        return self.cache.get(title)
+
+    def request_proof(
+        self,
+        name: str,
+        stream: Optional[ReplyStream] = None,
+    ) -> Record:
+        proof = self.known_proof(name)
+        if proof is not None:
+            return proof
+        title = normalize_title(name)
+        # Concurrent requests for the same title share a single fetch
+        proof = self.inflight.do(title, lambda: self.hedged_fetch(name, stream))
+        # The proof is cached under the title the name resolved to
+        self.cache.alias(title, proof.title)
+        return proof
+
+    def hedged_fetch(
+        self,
+        name: str,
+        stream: Optional[ReplyStream] = None,
+    ) -> Record:
+        # If ProofWiki is slower than usual to answer, send a duplicate
+        # request within the hedging budget and take whichever answers first
+        primary = self.hedge_pool.submit(self.try_fetch_proof, name, stream)
+        delay = self.scheduler.hedge_delay()
+        if delay is None:
+            return primary.result()
+        done, _ = futures.wait([primary], timeout=delay)
+        if len(done) > 0 or not self.scheduler.hedge():
+            return primary.result()
+        self.logger.info("Hedging request for %s after %.2fs", name, delay)
+        self.count("hedges")
+        backup = self.hedge_pool.submit(self.try_fetch_proof, name)
+        pending = {primary, backup}
+        while len(pending) > 0:
+            done, pending = futures.wait(
+                pending,
+                return_when=futures.FIRST_COMPLETED,
+            )
+            for job in done:
+                if job.exception() is None:
+                    self.count("hedge_wins" if job is backup else "hedge_losses")
+                    return job.result()
+        return primary.result()
+
+    def random_proof(self, client: str, filters: Filters = Filters()) -> Record:
+        if filters != Filters():
+            return self.filtered_proof(client, filters)
+        while True:
+            try:
+                proof = self.queue.get(client, timeout=ProofServer.queue_poll)
+                self.update_status()
+                return proof
+            except Empty:
+                # Serve from the cache while ProofWiki is unreachable
+                if not self.scheduler.healthy:
+                    proof = self.cache.random()
+                    if proof is not None and self.within_limit(proof):
+                        return proof
+
+    def filtered_proof(self, client: str, filters: Filters) -> Record:
+        # Sample fetched proofs directly. Everything the prefetcher fetches is
+        # cached, so waiting briefly for more gives more to choose from,
+        # without taking proofs from the queue.
+        if self.limit is not None:
+            max_lines = self.limit
+            if filters.max_lines is not None:
+                max_lines = min(max_lines, filters.max_lines)
+            filters = filters._replace(max_lines=max_lines)
+        exclude = self.recent.get(client) if filters.unseen else set()
+        deadline = time.monotonic() + ProofServer.filter_wait
+        while True:
+            proof = self.cache.sample(filters, exclude)
+            if proof is not None:
+                return proof
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.cache.wait(remaining):
+                raise FetchError(Code.NOT_FOUND)
+
+    def within_limit(self, proof: Record) -> bool:
+        return self.limit is None or proof.lines <= self.limit
+
+    def enqueue_proof(self, proof: Record) -> None:
+        if self.within_limit(proof) and not self.over_budget(proof.nbytes()):
             self.queue.put(proof)
+            self.rebalance()
+            # Publish the fill level promptly so that waiting for a warm
+            # daemon doesn't lag behind
+            self.write_status()
+
+    def warm_from_cache(self) -> int:
+        titles = self.cache.titles()
+        random.shuffle(titles)
+        for title in titles:
+            if self.queue.qsize() >= self.queue.maxsize:
+                break
+            proof = self.cache.peek(title)
+            if proof is None or not self.within_limit(proof):
+                continue
+            if not self.over_budget(proof.nbytes()):
+                self.queue.put(proof)
+        self.rebalance()
+        return self.queue.qsize()
+
+    def create_ring(self) -> Optional[ProofRing]:
+        # The ring's file is mapped in whole, so it has to fit in the memory
+        # budget from the start
+        nslots = max(1, self.queue.maxsize // 2)
+        if self.max_memory is not None:
+            share = self.max_memory * ProofServer.queue_share * ProofServer.ring_share
+            fit = int(share - ProofRing.header.size) // ProofServer.ring_slot_size
+            nslots = min(nslots, fit)
+            if nslots <= 0:
+                self.logger.info("No room for the proof ring in the memory budget")
+                return None
+        try:
+            return ProofRing.create(
+                self.status.file.parent / consts.RING_FILE,
+                nslots,
+                ProofServer.ring_slot_size,
+            )
+        except OSError as e:
+            self.logger.info("Failed to create the proof ring: %s", e)
+            return None
 
-    def fetch_proofs(self) -> NoReturn:
-        with futures.ThreadPoolExecutor(
+    def feed_ring(self) -> None:
+        # Move prefetched proofs into the ring as local clients empty it,
+        # leaving the rest of the queue for socket requests
+        ring = cast(ProofRing, self.ring)
+        filled = 0
+        while not self.stop_event.is_set():
+            # Proofs taken from the ring are requests too
+            count = ring.count()
+            if count < filled:
+                self.last_request = time.monotonic()
+            filled = count
+            if count >= ring.nslots:
+                self.stop_event.wait(ProofServer.ring_poll)
+                continue
+            try:
+                proof = self.queue.get(
+                    ProofServer.ring_client,
+                    timeout=ProofServer.queue_poll,
+                )
+            except Empty:
+                continue
+            renders = [proof.render(fmt)[1] for fmt in Format]
+            self.cache.remeasure(proof)
+            if ring.put(renders):
+                filled += 1
+                self.write_status()
+            else:
+                # Too large for a slot, leave it to be requested if the queue
+                # still has room for it
+                if not self.over_budget(proof.nbytes()):
+                    self.queue.put(proof)
+                self.stop_event.wait(ProofServer.ring_poll)
+
+    def fetch_proofs(self) -> None:
+        # The pool isn't waited on at exit, fetches still running after the
+        # shutdown grace period are abandoned
+        pool = futures.ThreadPoolExecutor(
             max_workers=ProofServer.max_threads,
             thread_name_prefix="Fetcher",
-        ) as pool:
-            jobs: Set[ProofFuture] = set()
-            while True:
-                njobs = self.queue.maxsize - self.queue.qsize() - len(jobs)
-                if len(jobs) == 0:
-                    njobs = max(njobs, 1)
-                jobs |= {pool.submit(self.fetch_proof) for _ in range(njobs)}
-                done, jobs = futures.wait(jobs, return_when=futures.FIRST_COMPLETED)
+        )
+        while not self.stop_event.is_set():
+            delay = self.scheduler.delay()
+            if delay > 0:
+                self.logger.info("Backing off for %.1fs", delay)
+                if self.stop_event.wait(delay):
+                    break
+            njobs = self.queue.maxsize - self.queue.qsize() - len(self.jobs)
+            if not self.scheduler.healthy:
+                # Send a single trial request while the circuit is open
+                njobs = min(njobs, 1 - len(self.jobs))
+            if self.over_budget():
+                if len(self.jobs) == 0:
+                    self.stop_event.wait(ProofServer.queue_poll)
+                    self.update_status()
+                    continue
+                njobs = 0
+            elif len(self.jobs) == 0:
+                njobs = max(njobs, 1)
+            # Replace rather than update the set of jobs, so that it can be
+            # waited on from another thread
+            self.jobs = self.jobs | {
+                pool.submit(self.fetch_proof) for _ in range(njobs)
+            }
+            done, self.jobs = futures.wait(
+                self.jobs,
+                return_when=futures.FIRST_COMPLETED,
+            )
 
-                for job in done:
-                    proof = job.result()
-                    if proof is not None:
-                        self.enqueue_proof(proof)
+            for job in done:
+                proof = job.result()
+                if proof is not None and not self.stop_event.is_set():
+                    self.enqueue_proof(proof)
+
+            self.update_status()
+        pool.shutdown(wait=False)
+
+    def idle(self) -> bool:
+        # Only refresh while prefetching has nothing to do
+        full = self.queue.qsize() >= self.queue.maxsize or self.over_budget()
+        return self.scheduler.healthy and full
+
+    def wait_idle(self) -> bool:
+        # Returns whether the daemon became idle before being stopped
+        while not self.idle():
+            if self.stop_event.wait(ProofServer.queue_poll):
+                return False
+        return True
+
+    def refresh_proof(self, title: str, revision: int) -> None:
+        self.scheduler.acquire()
+        try:
+            proof = self.try_fetch_proof(title)
+            # Keep the revision looked up for pages that don't report theirs,
+            # so that they aren't fetched again every time
+            if proof.revision is None:
+                proof.revision = revision
+            self.cache.put(title, proof)
+            self.logger.info("Refreshed %s", title)
+        except FetchError as e:
+            if e.code is Code.NOT_FOUND:
+                self.cache.remove(title)
+
+    def refresh_proofs(self) -> None:
+        # Walk the cache in the background, refetching only pages whose latest
+        # revision differs from the cached one
+        while not self.stop_event.wait(ProofServer.refresh_interval):
+            titles = self.cache.titles()
+            for idx in range(0, len(titles), ProofServer.refresh_batch):
+                if not self.wait_idle():
+                    return
+                self.scheduler.acquire()
+                batch = titles[idx : idx + ProofServer.refresh_batch]
+                try:
+                    revisions = wiki.revisions(batch, self.scheduler.timeout)
+                except (exs.RequestException, ValueError, KeyError) as e:
+                    self.logger.info("Failed to fetch revisions: %s", e)
+                    continue
+                for title in batch:
+                    proof = self.cache.peek(title)
+                    if proof is None or title not in revisions:
+                        continue
+                    revision = revisions[title]
+                    if revision is None:
+                        self.logger.info("%s no longer exists", title)
+                        self.cache.remove(title)
+                        continue
+                    if revision == proof.revision:
+                        continue
+                    if not self.wait_idle():
+                        return
+                    self.refresh_proof(title, revision)
+            self.cache.save(self.cache_file)
 
 
 def spawn(**kwargs: Any) -> None:
-    with DaemonContext(stdout=sys.stdout, stderr=sys.stderr):
-        # N.B. shutdown() must be called in a separate thread
-        signal.signal(
-            signal.SIGTERM,
-            lambda signum, frame: threading.Thread(target=server.shutdown).start(),
-        )
+    # Keep files created by a shared daemon from being writable by other users
+    listen_fd = kwargs.get("listen_fd")
+    with DaemonContext(
+        stdout=sys.stdout,
+        stderr=sys.stderr,
+        umask=0o022,
+        files_preserve=[listen_fd] if listen_fd is not None else None,
+    ):
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
         try:
             with ProofServer(**kwargs) as server:
-                server.serve_forever()
+                server.serve_forever(poll_interval=ProofServer.stop_poll)
         except ServerError as e:
             sys.exit(str(e))
+        # Don't wait on abandoned fetches, everything worth keeping is saved
+        os._exit(0)  # pylint: disable=protected-access
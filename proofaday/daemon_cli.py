@@ -1,15 +1,19 @@
+import json
 import os
+import shutil
 import signal
 import sys
 from pathlib import Path
-from typing import Any, Callable, TypeVar
+from typing import IO, Any, Callable, Optional, TypeVar
 
 import click
 
 import proofaday.constants as consts
-from proofaday.cli_util import ClickPath
+from proofaday import snapshot
+from proofaday.cli_util import ClickPath, byte_size
 from proofaday.daemon import ServerError, spawn
-from proofaday.status import Status
+from proofaday.status import Status, shared_dir
+from proofaday.wiki import Source
 
 pass_status = click.make_pass_decorator(Status)
 
@@ -25,6 +29,31 @@ class ServerInvoker(click.Group):
 F = TypeVar("F", bound=Callable[..., Any])
 
 
+def cache_dir(status: Status, cache_path: Optional[Path]) -> Path:
+    if cache_path is not None:
+        return cache_path
+    return Path(consts.SHARED_CACHE_PATH if status.shared else consts.CACHE_PATH)
+
+
+cache_path_option = click.option(
+    "--cache-path",
+    help="Directory to place cached data.",
+    type=ClickPath(exists=False, file_okay=False),
+    default=None,
+)
+
+
+def activation_fd() -> Optional[int]:
+    # Only take the socket if it was passed to this process
+    try:
+        pid, nfds = int(os.environ["LISTEN_PID"]), int(os.environ["LISTEN_FDS"])
+    except (KeyError, ValueError):
+        return None
+    if pid != os.getpid() or nfds < 1:
+        return None
+    return consts.LISTEN_FDS_START
+
+
 def start_options(f: F) -> F:
     for opt in (
         click.option(
@@ -56,6 +85,39 @@ def start_options(f: F) -> F:
             default=consts.NPREFETCH,
             show_default=True,
         ),
+        click.option(
+            "-c",
+            "--num-cached-proofs",
+            "ncache",
+            help="Number of recently fetched proofs to keep for reuse.",
+            type=click.IntRange(min=0),
+            default=consts.NCACHE,
+            show_default=True,
+        ),
+        click.option(
+            "--max-memory",
+            help=(
+                "Memory for prefetched and cached proofs, such as 64M. Use 0"
+                " for no limit."
+            ),
+            type=byte_size,
+            metavar="SIZE",
+            default=0,
+            show_default=True,
+            callback=lambda ctx, param, value: value or None,
+        ),
+        click.option(
+            "--source",
+            help=(
+                "Where to fetch proofs from: full wiki pages, page content"
+                " found through the MediaWiki API, or page source parsed"
+                " without a DOM."
+            ),
+            type=click.Choice([source.value for source in Source]),
+            default=Source.WIKITEXT.value,
+            show_default=True,
+            callback=lambda ctx, param, value: Source(value),
+        ),
         click.option(
             "-d",
             "--debug",
@@ -68,6 +130,52 @@ def start_options(f: F) -> F:
             type=ClickPath(exists=False, file_okay=False),
             default=consts.LOG_PATH,
         ),
+        click.option(
+            "--log-format",
+            help="Write the debug log as text or as JSON lines.",
+            type=click.Choice(["text", "json"]),
+            default="text",
+            show_default=True,
+        ),
+        cache_path_option,
+        click.option(
+            "--warm-cache/--no-warm-cache",
+            help="Fill the prefetch queue from cached proofs on startup.",
+            default=False,
+        ),
+        click.option(
+            "--ring/--no-ring",
+            help=(
+                "Share prefetched proofs with local clients through a memory"
+                " mapped file. Shared daemons only use the socket."
+            ),
+            default=True,
+        ),
+        click.option(
+            "--idle-timeout",
+            help="Exit after this many seconds without a request. Use 0 to never exit.",
+            type=click.FloatRange(min=0),
+            default=0,
+            show_default=True,
+        ),
+        click.option(
+            "--listen-fd",
+            help=(
+                "Serve on an already bound UDP socket passed in as this file"
+                " descriptor. Sockets passed by systemd socket activation are"
+                " found automatically."
+            ),
+            metavar="FD",
+            type=click.IntRange(min=0),
+            default=None,
+        ),
+        click.option(
+            "--wait-warm",
+            help="Return once this many proofs are prefetched.",
+            metavar="N",
+            type=click.IntRange(min=0),
+            default=0,
+        ),
     ):
         f = opt(f)
     return f
@@ -80,15 +188,28 @@ def start_options(f: F) -> F:
     help="Disable output.",
     default=False,
 )
+@click.option(
+    "-s",
+    "--shared/--no-shared",
+    help="Use a single daemon shared by all users.",
+    default=False,
+)
 @click.option(
     "--status-path",
     help="Directory to place the status file.",
     type=ClickPath(exists=False, file_okay=False),
-    default=consts.DATA_PATH,
+    default=None,
 )
 @click.pass_context
-def main(ctx: click.core.Context, quiet: bool, status_path: Path) -> None:
-    ctx.obj = Status(status_path)
+def main(
+    ctx: click.core.Context,
+    quiet: bool,
+    shared: bool,
+    status_path: Optional[Path],
+) -> None:
+    if status_path is None:
+        status_path = Path(consts.SHARED_DATA_PATH if shared else consts.DATA_PATH)
+    ctx.obj = Status(status_path, shared=shared)
     if quiet:
         # pylint: disable=consider-using-with
         sys.stdout = sys.stderr = open(os.devnull, "w", encoding="utf-8")
@@ -97,13 +218,44 @@ def main(ctx: click.core.Context, quiet: bool, status_path: Path) -> None:
 @main.command(help="Start the daemon.")
 @start_options
 @pass_status
-def start(status: Status, force: bool, **kwargs: Any) -> None:
+def start(
+    status: Status,
+    force: bool,
+    cache_path: Optional[Path],
+    wait_warm: int,
+    listen_fd: Optional[int],
+    warm_cache: bool,
+    **kwargs: Any,
+) -> None:
+    if wait_warm > kwargs["nprefetch"]:
+        raise click.BadParameter(
+            "can't wait for more proofs than are prefetched.",
+            param_hint="--wait-warm",
+        )
     if status.read() is not None:
         if not force:
             raise ServerError("Daemon already started.")
         if not status.remove():
             raise ServerError("Failed to remove status file.")
-    spawn(status=status, **kwargs)
+    cache_path = cache_dir(status, cache_path)
+    if listen_fd is None:
+        listen_fd = activation_fd()
+    # A daemon started on demand answers from the cache right away
+    warm_cache = warm_cache or listen_fd is not None
+    # The daemon detaches from this process, so wait from a fork
+    if wait_warm > 0 and os.fork() != 0:
+        if not status.wait(exist=True, timeout=Status.start_timeout):
+            raise ServerError("Daemon failed to start.")
+        if not status.wait_warm(wait_warm):
+            raise ServerError("Daemon stopped before warming up.")
+        return
+    spawn(
+        status=status,
+        cache_path=cache_path,
+        listen_fd=listen_fd,
+        warm_cache=warm_cache,
+        **kwargs,
+    )
 
 
 @main.command(help="Stop the daemon.")
@@ -117,7 +269,11 @@ def stop(status: Status) -> None:
     except ProcessLookupError as e:
         raise ServerError("Daemon not running.") from e
     finally:
-        if not status.wait(exist=False):
+        if not status.wait(
+            exist=False,
+            timeout=Status.stop_timeout,
+            interval=Status.stop_poll,
+        ):
             raise ServerError("Failed to stop daemon.")
 
 
@@ -135,7 +291,7 @@ def restart(ctx: click.core.Context, status: Status, **kwargs: Any) -> None:
 @click.option(
     "-w",
     "--wait/--no-wait",
-    help="Block until the status is available.",
+    help="Block until the daemon has a proof ready.",
     default=False,
 )
 @pass_status
@@ -143,11 +299,72 @@ def status(status: Status, wait: bool) -> None:
     try:
         if wait:
             status.wait(exist=True, timeout=None)
+            status.wait_warm(1)
         click.echo(status)
     except ValueError as e:
         raise ServerError("Failed to read status file.") from e
 
 
+@main.command(help="Write the proofs the daemon last saved to a snapshot.")
+@cache_path_option
+@click.argument("output", type=click.File("wb"))
+@pass_status
+def export(status: Status, cache_path: Optional[Path], output: IO[bytes]) -> None:
+    file = cache_dir(status, cache_path) / consts.PROOF_CACHE_FILE
+    try:
+        with file.open(encoding="utf-8") as f:
+            count = snapshot.write(output, (json.loads(line) for line in f))
+    except (OSError, ValueError) as e:
+        raise ServerError(f"Failed to export proofs: {e}") from e
+    click.echo(f"Exported {count} proofs.", err=True)
+
+
+@main.command("import", help="Add the proofs in a snapshot to the cache.")
+@cache_path_option
+@click.option(
+    "--replace/--merge",
+    help="Replace the cached proofs instead of adding to them.",
+    default=False,
+)
+@click.argument("source", type=click.File("rb"))
+@pass_status
+def import_(
+    status: Status,
+    cache_path: Optional[Path],
+    replace: bool,
+    source: IO[bytes],
+) -> None:
+    # A running daemon would overwrite the cache when it saves it
+    if status.read() is not None:
+        raise ServerError("Stop the daemon before importing.")
+    file = cache_dir(status, cache_path) / consts.PROOF_CACHE_FILE
+    if status.shared and not shared_dir(file.parent):
+        raise ServerError("Shared cache directory is writable by others.")
+    # Write the new cache alongside, replacing it once the whole snapshot
+    # has been verified
+    tmp = file.with_suffix(".import")
+    count = 0
+    try:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with tmp.open("w", encoding="utf-8") as out:
+            if not replace and file.is_file():
+                with file.open(encoding="utf-8") as f:
+                    shutil.copyfileobj(f, out)
+            for entry in snapshot.read(source):
+                if "key" not in entry:
+                    raise snapshot.SnapshotError("Snapshot entry has no key.")
+                out.write(json.dumps(entry) + "\n")
+                count += 1
+        os.replace(tmp, file)
+    except (OSError, snapshot.SnapshotError) as e:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        raise ServerError(f"Failed to import proofs: {e}") from e
+    click.echo(f"Imported {count} proofs.", err=True)
+
+
 if __name__ == "__main__":
     # pylint: disable=no-value-for-parameter
     main()
@@ -0,0 +1,70 @@
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from typing_extensions import Final
+
+import proofaday.constants as consts
+
+MAX_BYTES: Final = 1024 * 1024
+TEXT_FORMAT: Final = "%(threadName)s: %(message)s"
+# Extra fields attached to records, such as per-request timing
+FIELDS: Final = ("action", "client", "title", "code", "elapsed_ms")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "time": record.created,
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info is not None:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    # Hand records to the listener as they are. The default handler formats
+    # the message in the logging thread.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def init_logger(
+    name: str,
+    level: int,
+    path: Path,
+    structured: bool = False,
+) -> Tuple[logging.Logger, Optional[QueueListener]]:
+    # Records are written by a listener thread, so that file writes and
+    # rollovers stay off the threads that log them
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    for old in logger.handlers[:]:
+        logger.removeHandler(old)
+    if level == logging.NOTSET:
+        logger.addHandler(logging.NullHandler())
+        return logger, None
+
+    path.mkdir(parents=True, exist_ok=True)
+    handler = RotatingFileHandler(
+        path / consts.LOG_FILE,
+        maxBytes=MAX_BYTES,
+        backupCount=1,
+        encoding="utf8",
+    )
+    formatter = JsonFormatter() if structured else logging.Formatter(TEXT_FORMAT)
+    handler.setFormatter(formatter)
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue()
+    listener = QueueListener(records, handler)
+    listener.start()
+    logger.addHandler(LazyQueueHandler(records))
+    return logger, listener
@@ -1,4 +1,11 @@
+import struct
 from enum import IntEnum
+from typing import List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, urlencode
+
+from typing_extensions import Final
+
+from proofaday.codec import Buffer, Codec
 
 
 class Action(IntEnum):
@@ -6,22 +13,272 @@ class Action(IntEnum):
     RANDOM = 2
 
 
+class Format(IntEnum):
+    PLAIN = 0
+    LATEX = 1
+    JSON = 2
+    ANSI = 3
+
+
+class Code(IntEnum):
+    OK = 0
+    NOT_FOUND = 1
+    UNAVAILABLE = 2
+    ERROR = 3
+
+
+class MessageError(Exception):
+    pass
+
+
+# Legacy messages are a single byte with the action in the low nibble, then
+# the format and the compression the client accepts, followed by the payload.
+# Messages from the oldest clients have neither and get uncompressed plain
+# text.
+ACTION_MASK = 0x0F
+FORMAT_SHIFT = 4
+FORMAT_MASK = 0x03
+CODEC_SHIFT = 6
+CODEC_MASK = 0x03
+
+# Versioned messages start with a zero byte, which is never a valid legacy
+# action, followed by the version, action, flags, request id, status code and
+# payload length.
+MAGIC: Final = 0
+VERSION: Final = 1
+HEADER: Final = struct.Struct("!BBBBIBI")
+FLAG_FORMAT_SHIFT = 0
+FLAG_CODEC_SHIFT = 2
+# In requests, the client accepts a reply in parts. In replies, this is one
+# of the parts, numbered at the start of the payload.
+FLAG_STREAM = 1 << 4
+FLAG_LAST = 1 << 5
+PART: Final = struct.Struct("!H")
+# The most a single datagram can carry
+MAX_SIZE: Final = 65535
+
+
+def pack_flags(fmt: Format, codec: Codec) -> int:
+    return fmt << FLAG_FORMAT_SHIFT | codec << FLAG_CODEC_SHIFT
+
+
+def unpack_flags(flags: int) -> Tuple[Format, Codec]:
+    return (
+        Format(flags >> FLAG_FORMAT_SHIFT & FORMAT_MASK),
+        Codec(flags >> FLAG_CODEC_SHIFT & CODEC_MASK),
+    )
+
+
 class Message:
-    def __init__(self, action: Action, data: str = "") -> None:
+    def __init__(
+        self,
+        action: Action,
+        data: str = "",
+        fmt: Format = Format.PLAIN,
+        codec: Codec = Codec.NONE,
+        request_id: Optional[int] = None,
+        stream: bool = False,
+    ) -> None:
         self.action = action
         self.data = data
+        self.fmt = fmt
+        self.codec = codec
+        self.request_id = request_id
+        self.stream = stream
 
     def encode(self) -> bytes:
-        return bytes((self.action,)) + self.data.encode()
+        payload = self.data.encode()
+        if self.request_id is None:
+            header = self.action | self.fmt << FORMAT_SHIFT | self.codec << CODEC_SHIFT
+            return bytes((header,)) + payload
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            self.action,
+            pack_flags(self.fmt, self.codec) | (FLAG_STREAM if self.stream else 0),
+            self.request_id,
+            Code.OK,
+            len(payload),
+        )
+        return header + payload
 
     @staticmethod
     def decode(data: bytes) -> "Message":
-        return Message(Action(data[0]), data[1:].decode())
+        if len(data) == 0:
+            raise MessageError("Empty message")
+        if data[0] != MAGIC:
+            return Message(
+                Action(data[0] & ACTION_MASK),
+                data[1:].decode(),
+                Format(data[0] >> FORMAT_SHIFT & FORMAT_MASK),
+                Codec(data[0] >> CODEC_SHIFT & CODEC_MASK),
+            )
+        if len(data) < HEADER.size:
+            raise MessageError("Truncated header")
+        _, version, action, flags, request_id, _, length = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise MessageError(f"Unsupported version {version}")
+        payload = data[HEADER.size :]
+        if len(payload) != length:
+            raise MessageError("Truncated message")
+        fmt, codec = unpack_flags(flags)
+        stream = flags & FLAG_STREAM != 0
+        return Message(Action(action), payload.decode(), fmt, codec, request_id, stream)
+
+    def reply(
+        self, code: Code, payload: Buffer = b"", codec: Codec = Codec.NONE
+    ) -> bytes:
+        return b"".join(self.reply_parts(code, payload, codec))
+
+    def reply_parts(
+        self,
+        code: Code,
+        payload: Buffer = b"",
+        codec: Codec = Codec.NONE,
+        part: Optional[int] = None,
+        last: bool = True,
+    ) -> List[Buffer]:
+        # The payload is passed through as is, for scatter sends
+        if self.request_id is None:
+            # Legacy replies are bare, with a codec tag if compression was
+            # offered
+            if self.codec is Codec.NONE or len(payload) == 0:
+                return [payload]
+            return [TAGS[codec], payload]
+        reply = Reply(code, payload, codec, self.request_id, self.action, part, last)
+        if part is None:
+            return [reply.header(), payload]
+        return [reply.header(), PART.pack(part), payload]
+
+
+# Random requests carry the client's name, optionally followed by a separator
+# and the filters as a query string
+FILTER_SEP: Final = "\0"
+
+
+class Filters(NamedTuple):
+    max_lines: Optional[int] = None
+    category: Optional[str] = None
+    unseen: bool = False
+
+    def encode(self) -> str:
+        params = {}
+        if self.max_lines is not None:
+            params["lines"] = str(self.max_lines)
+        if self.category is not None:
+            params["category"] = self.category
+        if self.unseen:
+            params["unseen"] = "1"
+        return urlencode(params)
+
+    @staticmethod
+    def decode(data: str) -> "Filters":
+        params = {key: values[-1] for key, values in parse_qs(data).items()}
+        lines = params.get("lines")
+        return Filters(
+            int(lines) if lines is not None else None,
+            params.get("category"),
+            params.get("unseen") == "1",
+        )
+
+
+def parse_random(data: str) -> Tuple[str, Filters]:
+    client, _, filters = data.partition(FILTER_SEP)
+    return client, Filters.decode(filters)
+
+
+TAGS: Final = {codec: bytes((codec,)) for codec in Codec}
+
+
+class Reply:
+    def __init__(
+        self,
+        code: Code,
+        payload: Buffer,
+        codec: Codec,
+        request_id: int,
+        action: Action,
+        part: Optional[int] = None,
+        last: bool = True,
+    ) -> None:
+        self.code = code
+        self.payload = payload
+        self.codec = codec
+        self.request_id = request_id
+        self.action = action
+        self.part = part
+        self.last = last
+
+    def header(self) -> bytes:
+        flags = pack_flags(Format.PLAIN, self.codec)
+        length = len(self.payload)
+        if self.part is not None:
+            flags |= FLAG_STREAM | (FLAG_LAST if self.last else 0)
+            length += PART.size
+        return HEADER.pack(
+            MAGIC,
+            VERSION,
+            self.action,
+            flags,
+            self.request_id,
+            self.code,
+            length,
+        )
+
+    def encode(self) -> bytes:
+        if self.part is None:
+            return self.header() + self.payload
+        return self.header() + PART.pack(self.part) + self.payload
+
+    @staticmethod
+    def decode(data: Buffer) -> "Reply":
+        # Slicing a memoryview leaves the payload in the receive buffer
+        if len(data) < HEADER.size or data[0] != MAGIC:
+            raise MessageError("Malformed reply")
+        _, version, action, flags, request_id, code, length = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise MessageError(f"Unsupported version {version}")
+        payload = data[HEADER.size :]
+        if len(payload) != length:
+            raise MessageError("Truncated reply")
+        part = None
+        if flags & FLAG_STREAM != 0:
+            if len(payload) < PART.size:
+                raise MessageError("Truncated part")
+            (part,) = PART.unpack_from(payload)
+            payload = payload[PART.size :]
+        try:
+            return Reply(
+                Code(code),
+                payload,
+                unpack_flags(flags)[1],
+                request_id,
+                Action(action),
+                part,
+                flags & FLAG_LAST != 0,
+            )
+        except ValueError as e:
+            raise MessageError(f"Malformed reply: {e}") from e
 
 
-def request(data: str) -> Message:
-    return Message(Action.REQUEST, data)
+def request(
+    data: str,
+    fmt: Format = Format.PLAIN,
+    codec: Codec = Codec.NONE,
+    request_id: Optional[int] = None,
+    stream: bool = False,
+) -> Message:
+    return Message(Action.REQUEST, data, fmt, codec, request_id, stream)
 
 
-def random() -> Message:
-    return Message(Action.RANDOM)
+def random(
+    client: str = "",
+    fmt: Format = Format.PLAIN,
+    codec: Codec = Codec.NONE,
+    request_id: Optional[int] = None,
+    filters: Filters = Filters(),
+    stream: bool = False,
+) -> Message:
+    if filters != Filters():
+        client += FILTER_SEP + filters.encode()
+    return Message(Action.RANDOM, client, fmt, codec, request_id, stream)
@@ -1,5 +1,6 @@
+import json
 import re
-from typing import Any, List, Tuple
+from typing import Any, Dict, List, Match, Optional, Sequence, Tuple
 
 from typing_extensions import Final
 
@@ -10,54 +11,187 @@ class InvalidProofException(Exception):
     pass
 
 
+class ProofTooLongException(InvalidProofException):
+    pass
+
+
+# A page with a theorem and proof that the wikitext parser can't handle, but
+# which the wiki itself may render fine
+class UnsupportedMarkupException(InvalidProofException):
+    pass
+
+
+class PreScan:
+    # Cheaply reject pages from their raw bytes before building a DOM
+    markers: Final = {
+        "theorem": b'id="Theorem"',
+        "proof": b'id="Proof"',
+        "proof end": b"blacksquare",
+    }
+    content_end: Final = b'class="printfooter"'
+    revision_id: Final = re.compile(rb'"wgRevisionId":\s*(\d+)')
+    categories_list: Final = re.compile(rb'"wgCategories":\s*(\[[^\]]*\])')
+    section: Final = b"<h2"
+    blocks: Final = re.compile(rb"<(?:p|dl)[\s>]")
+    overlap: Final = max(len(m) for m in (*markers.values(), content_end))
+    # Title, underline, blank line, and "Proof:"
+    extra_lines: Final = 4
+
+    def __init__(self, limit: Optional[int] = None) -> None:
+        self.limit = limit
+        self.data = bytearray()
+        self.found: Dict[str, int] = {}
+        self.counted = 0
+        self.nblocks = 0
+
+    def feed(self, chunk: bytes) -> bool:
+        start = max(0, len(self.data) - PreScan.overlap)
+        self.data += chunk
+
+        for name, marker in PreScan.markers.items():
+            if name not in self.found:
+                # The proof end only counts if it comes after the proof heading
+                after = self.found.get("proof") if name == "proof end" else start
+                if after is None:
+                    continue
+                idx = self.data.find(marker, max(start, after))
+                if idx != -1:
+                    self.found[name] = idx
+
+        self.estimate_lines()
+        if self.data.find(PreScan.content_end, start) != -1:
+            self.check()
+            return True
+        # Nothing after the section containing the proof end is needed
+        end = self.found.get("proof end")
+        return end is not None and self.data.find(PreScan.section, end) != -1
+
+    def estimate_lines(self) -> None:
+        if self.limit is None or "theorem" not in self.found:
+            return
+        stop = self.found.get("proof end", len(self.data) - PreScan.overlap)
+        start = max(self.counted, self.found["theorem"])
+        if start < stop:
+            self.nblocks += sum(
+                1 for _ in PreScan.blocks.finditer(self.data, start, stop)
+            )
+            self.counted = stop
+        # Every paragraph renders to at least one line
+        if self.nblocks + PreScan.extra_lines > self.limit:
+            raise ProofTooLongException(
+                f"At least {self.nblocks + PreScan.extra_lines} lines"
+                f" (limit {self.limit})",
+            )
+
+    def revision(self) -> Optional[int]:
+        match = PreScan.revision_id.search(self.data)
+        return int(match.group(1)) if match is not None else None
+
+    def categories(self) -> List[str]:
+        # The category links come after the content, but the page config in
+        # the head lists them too
+        match = PreScan.categories_list.search(self.data)
+        if match is None:
+            return []
+        try:
+            return [str(category) for category in json.loads(match.group(1))]
+        except ValueError:
+            return []
+
+    def check(self) -> None:
+        missing = [name for name in PreScan.markers if name not in self.found]
+        if missing != []:
+            raise InvalidProofException(f"Missing {', '.join(missing)}.")
+
+
 class Proof:
     proof_end: Final = re.compile("blacksquare")
     tags: Final = ("p", "dl", "table")
 
-    def __init__(self, html: Any) -> None:
-        self.title, self._theorem, self._proof = self.parse(html)
+    def __init__(
+        self,
+        html: Any,
+        title: Optional[str] = None,
+        categories: Sequence[str] = (),
+    ) -> None:
+        self.title, self._theorem, self._proof = self.parse(html, title)
         self.theorem = latex_to_text(self._theorem)
         self.proof = latex_to_text(self._proof)
+        self.categories = tuple(categories) or self.find_categories(html)
+
+    def find_categories(self, html: Any) -> Tuple[str, ...]:
+        # pylint: disable=unused-argument
+        return ()
 
-    def parse(self, html: Any) -> Tuple[str, str, str]:
-        title = html.find("h1", id="firstHeading")
-        body = html.find("div", id="bodyContent")
+    @staticmethod
+    def locate(html: Any, title: Optional[str] = None) -> Tuple[str, Any, Any]:
+        # Rendered page content alone has no heading or body container
+        heading = html.find("h1", id="firstHeading")
+        title = heading.get_text() if heading is not None else title
+        body = html.find("div", id="bodyContent") or html
         theorem = body.find("span", id="Theorem")
         proof = body.find("span", id="Proof")
 
-        if any(x is None for x in (title, theorem, proof)):
+        if title is None or theorem is None or proof is None:
             missing = [
                 x
                 for x, y in zip(("title", "theorem", "proof"), (title, theorem, proof))
                 if y is None
             ]
             raise InvalidProofException(f"Missing {', '.join(missing)}.")
+        return title, theorem, proof
+
+    @staticmethod
+    def preview(html: Any, title: Optional[str] = None) -> Tuple[str, str]:
+        # The title and theorem from a page cut off after the proof heading
+        title, theorem, proof = Proof.locate(html, title)
+        theorem_body = []
+        for node in theorem.parent.next_siblings:
+            if node is proof.parent:
+                break
+            if getattr(node, "name", None) in Proof.tags:
+                theorem_body.append(Proof.node_to_text(node))
+        if len(theorem_body) == 0:
+            raise InvalidProofException("Missing theorembody.")
+        return title, "".join(theorem_body).strip()
+
+    def parse(self, html: Any, title: Optional[str] = None) -> Tuple[str, str, str]:
+        title, theorem, proof = Proof.locate(html, title)
 
-        theorem_body = theorem.parent.find_next_siblings(Proof.tags)
-        proof_body = proof.parent.find_next_siblings(Proof.tags)
-        theorem_body = theorem_body[: -len(proof_body)]
+        # Walk forward once from the theorem heading, switching sections at
+        # the proof heading and stopping after the proof end
+        theorem_body: List[str] = []
+        proof_body: List[str] = []
+        section = theorem_body
+        ended = False
+        for node in theorem.parent.next_siblings:
+            if node is proof.parent:
+                section = proof_body
+            elif getattr(node, "name", None) in Proof.tags:
+                section.append(self.node_to_text(node))
+                if section is not proof_body:
+                    continue
+                # The end marker may be anywhere in the node, even where its
+                # text isn't extracted
+                if node.find(string=Proof.proof_end) is not None:
+                    ended = True
+                    break
 
-        if any(x == [] for x in (theorem_body, proof_body)):
+        if any(len(x) == 0 for x in (theorem_body, proof_body)):
             missing = [
                 x + "body"
                 for x, y in zip(("theorem", "proof"), (theorem_body, proof_body))
-                if y == []
+                if len(y) == 0
             ]
             raise InvalidProofException(f"Missing {', '.join(missing)}.")
 
-        # Strip text after proof end
-        for idx, node in enumerate(proof_body):
-            if node.find(string=Proof.proof_end) is not None:
-                proof_body = proof_body[: idx + 1]
-                break
-        else:
-            # No proof end found
+        if not ended:
             raise InvalidProofException(f"Missing proof end ({Proof.proof_end})")
 
         return (
-            title.get_text(),
-            "".join(self.node_to_text(node) for node in theorem_body).strip(),
-            "".join(self.node_to_text(node) for node in proof_body).strip(),
+            title,
+            "".join(theorem_body).strip(),
+            "".join(proof_body).strip(),
         )
 
     @staticmethod
@@ -87,3 +221,281 @@ class Proof:
             f"{self.title}\n{'=' * len(self.title)}\n"
             f"{self.theorem}\n\nProof:\n{self.proof}"
         )
+
+
+class WikitextProof(Proof):
+    heading: Final = re.compile(r"^(=+)\s*(.*?)\s*\1\s*$")
+    named_arg: Final = re.compile(r"^\s*(\w+)\s*=(.*)$", re.DOTALL)
+    link: Final = re.compile(r"\[\[(?:[^|\]]*\|)?([^\]]*)\]\]")
+    category: Final = re.compile(
+        r"\[\[Category:([^\]|]*)(?:\|[^\]]*)?\]\]",
+        re.IGNORECASE,
+    )
+    ref: Final = re.compile(r"<ref[^>/]*/>|<ref[^>]*>.*?</ref>", re.DOTALL)
+    comment: Final = re.compile(r"<!--.*?-->", re.DOTALL)
+    math: Final = re.compile(r"<math>(.*?)</math>|\$([^$\n]+)\$", re.DOTALL)
+    # Like MediaWiki, only treat known tags as markup, so that comparisons
+    # like x<y aren't mistaken for tags
+    tag: Final = re.compile(
+        r"</?(?:b|big|blockquote|br|center|code|div|em|font|i|includeonly"
+        r"|noinclude|nowiki|onlyinclude|p|poem|s|section|small|span|strong"
+        r"|sub|sup|u)\b[^<>]*>",
+        re.IGNORECASE,
+    )
+    math_span: Final = re.compile("\2(\\d+)\3")
+    emphasis: Final = re.compile(r"'{2,}")
+    qed: Final = ("qed", "qedlegacy")
+    # Maintenance notices, which carry nothing of the proof
+    notices: Final = (
+        "citation needed",
+        "explain",
+        "finish",
+        "help",
+        "improve",
+        "mistake",
+        "missingLinks",
+        "proofread",
+        "questionable",
+        "refactor",
+        "tidy",
+    )
+    # Stands in for templates that can't be expanded here
+    unknown: Final = "\4"
+    eqn_cells: Final = ("ll", "l", "o", "r", "c")
+    # Lines standing in for expanded table templates
+    row_start: Final = "\0row\0"
+    table_start: Final = "\0begin\0"
+    table_end: Final = "\0end\0"
+    cell_sep: Final = "\1"
+
+    def parse(self, html: Any, title: Optional[str] = None) -> Tuple[str, str, str]:
+        text, spans = WikitextProof.strip_markup(str(html))
+        text = WikitextProof.restore_math(WikitextProof.expand(text), spans)
+
+        sections: Dict[str, List[str]] = {}
+        current: Optional[List[str]] = None
+        for line in text.split("\n"):
+            heading = WikitextProof.heading.match(line)
+            if heading is not None:
+                name = heading.group(2)
+                if name in ("Theorem", "Proof") and name not in sections:
+                    current = sections[name] = []
+                elif current is not None:
+                    # Heading lines separate paragraphs like blank lines do
+                    current.append("")
+                continue
+            if current is not None:
+                current.append(line)
+
+        if title is None or "Theorem" not in sections or "Proof" not in sections:
+            missing = [
+                x
+                for x, y in zip(
+                    ("title", "theorem", "proof"),
+                    (title is not None, "Theorem" in sections, "Proof" in sections),
+                )
+                if not y
+            ]
+            raise InvalidProofException(f"Missing {', '.join(missing)}.")
+
+        # Like the HTML siblings, the theorem runs up to the proof heading and
+        # the proof runs past any later headings up to its end
+        theorem_body = WikitextProof.blocks(sections["Theorem"])
+        proof_body = WikitextProof.blocks(sections["Proof"])
+
+        if any(len(x) == 0 for x in (theorem_body, proof_body)):
+            missing = [
+                x + "body"
+                for x, y in zip(("theorem", "proof"), (theorem_body, proof_body))
+                if len(y) == 0
+            ]
+            raise UnsupportedMarkupException(f"Missing {', '.join(missing)}.")
+
+        for idx, block in enumerate(proof_body):
+            if Proof.proof_end.search(block) is not None:
+                proof_body = proof_body[: idx + 1]
+                break
+        else:
+            raise UnsupportedMarkupException(
+                f"Missing proof end ({Proof.proof_end})",
+            )
+
+        # Rather than leave out what a template says, let the page be parsed
+        # from HTML instead
+        if any(WikitextProof.unknown in block for block in theorem_body + proof_body):
+            raise UnsupportedMarkupException("Unsupported template")
+
+        return (
+            title,
+            "".join(theorem_body).strip(),
+            "".join(proof_body).strip(),
+        )
+
+    def find_categories(self, html: Any) -> Tuple[str, ...]:
+        return WikitextProof.page_categories(str(html))
+
+    @staticmethod
+    def page_categories(text: str) -> Tuple[str, ...]:
+        return tuple(
+            match.group(1).strip() for match in WikitextProof.category.finditer(text)
+        )
+
+    @staticmethod
+    def strip_markup(text: str) -> Tuple[str, List[str]]:
+        # Math is set aside so that neither markup nor templates are looked
+        # for inside it, and put back with restore_math
+        spans: List[str] = []
+
+        def protect(match: Match[str]) -> str:
+            math = match.group(1) if match.group(1) is not None else match.group(2)
+            spans.append(f"${math}$")
+            return f"\2{len(spans) - 1}\3"
+
+        text = WikitextProof.comment.sub("", text)
+        text = WikitextProof.ref.sub("", text)
+        text = WikitextProof.math.sub(protect, text)
+        text = WikitextProof.category.sub("", text)
+        text = WikitextProof.link.sub(r"\1", text)
+        text = WikitextProof.emphasis.sub("", text)
+        return WikitextProof.tag.sub("", text), spans
+
+    @staticmethod
+    def restore_math(text: str, spans: List[str]) -> str:
+        return WikitextProof.math_span.sub(lambda m: spans[int(m.group(1))], text)
+
+    @staticmethod
+    def split_args(body: str) -> List[str]:
+        # Split on pipes outside of nested braces
+        args, depth, start = [], 0, 0
+        for idx, c in enumerate(body):
+            if c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+            elif c == "|" and depth == 0:
+                args.append(body[start:idx])
+                start = idx + 1
+        args.append(body[start:])
+        return args
+
+    @staticmethod
+    def expand_template(body: str) -> str:
+        name, *args = WikitextProof.split_args(body)
+        name = name.strip()
+        key = name[:1].lower() + name[1:]
+        # The cells of an equation are LaTeX, where {{ is just a group
+        raw = key == "eqn"
+        named: Dict[str, str] = {}
+        positional: List[str] = []
+        for arg in args:
+            match = WikitextProof.named_arg.match(arg)
+            if match is not None:
+                cell = match.group(1)
+                value = match.group(2)
+                if not raw or cell == "c":
+                    value = WikitextProof.expand(value)
+                named[cell] = value.strip()
+            else:
+                positional.append(WikitextProof.expand(arg).strip())
+
+        # pylint: disable=no-else-return
+        if key in WikitextProof.qed:
+            return r"$\blacksquare$"
+        elif key == "!":
+            return "|"
+        elif key == "begin-eqn":
+            return f"\n{WikitextProof.table_start}\n"
+        elif key == "end-eqn":
+            return f"\n{WikitextProof.table_end}\n"
+        elif key == "eqn":
+            if "r" in named:
+                named.setdefault("o", "=")
+            cells = [
+                named[cell] if cell == "c" else f"${named[cell]}$"
+                for cell in WikitextProof.eqn_cells
+                if named.get(cell, "") != ""
+            ]
+            return f"\n{WikitextProof.row_start}{WikitextProof.cell_sep.join(cells)}\n"
+        elif key == "defof" and len(positional) > 0:
+            return f"Definition of {positional[-1]}"
+        elif key == "link" and len(positional) > 0:
+            return positional[-1]
+        elif key in WikitextProof.notices:
+            return ""
+        return WikitextProof.unknown
+
+    @staticmethod
+    def expand(text: str) -> str:
+        out: List[str] = []
+        idx = 0
+        while True:
+            start = text.find("{{", idx)
+            if start == -1:
+                out.append(text[idx:])
+                return "".join(out)
+            out.append(text[idx:start])
+            # Track single braces so LaTeX groups like x^{2}} don't end the
+            # template early
+            depth = 0
+            for end in range(start, len(text)):
+                if text[end] == "{":
+                    depth += 1
+                elif text[end] == "}":
+                    depth -= 1
+                    if depth == 0:
+                        break
+            else:
+                # Leave what can't be parsed as it is rather than reject
+                # the proof
+                out.append(text[start:])
+                return "".join(out)
+            out.append(WikitextProof.expand_template(text[start + 2 : end - 1]))
+            idx = end + 1
+
+    @staticmethod
+    def blocks(lines: List[str]) -> List[str]:
+        # Group lines into the same paragraphs, definition lists and tables
+        # that the HTML parser sees, rendered the same way
+        blocks: List[str] = []
+        kind = ""
+        items: List[str] = []
+
+        def flush() -> None:
+            nonlocal kind, items
+            if kind == "p":
+                blocks.append("\n".join(items) + "\n")
+            elif kind == "dl":
+                text = "\n".join(items)
+                blocks.append(f"\\qquad{text}\n")
+            elif kind == "table" and len(items) > 0:
+                rows = [r"\qquad" + r"\ ".join(row.split("\1")) for row in items]
+                blocks.append(r"\\".join(rows) + "\n")
+            kind, items = "", []
+
+        for line in lines:
+            if line == WikitextProof.table_start:
+                flush()
+                kind = "table"
+            elif line.startswith(WikitextProof.row_start):
+                if kind != "table":
+                    flush()
+                    kind = "table"
+                items.append(line[len(WikitextProof.row_start) :])
+            elif line == WikitextProof.table_end:
+                flush()
+            elif kind == "table":
+                continue
+            elif line.strip() == "":
+                flush()
+            elif line.startswith(":"):
+                if kind != "dl":
+                    flush()
+                    kind = "dl"
+                items.append(line.lstrip(":").strip())
+            else:
+                if kind != "p":
+                    flush()
+                    kind = "p"
+                items.append(line)
+        flush()
+        return blocks
@@ -1,14 +1,36 @@
+import getpass
+import itertools
+import json
+import os
+import random
 import socket
+import subprocess
 import sys
+import time
 from pathlib import Path
-from typing import IO, Optional
+from types import TracebackType
+from typing import (
+    IO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+    cast,
+)
 
 import click
+from typing_extensions import Final
 
 import proofaday.constants as consts
-from proofaday import message
+from proofaday import codec, message
+from proofaday.cache import normalize_title
 from proofaday.cli_util import ClickPath
-from proofaday.message import Message
+from proofaday.message import Code, Filters, Format, Message, MessageError, Reply
+from proofaday.ring import ProofRing
 from proofaday.status import Status
 
 
@@ -16,34 +38,272 @@ class ClientError(Exception):
     pass
 
 
+ERRORS: Dict[Code, str] = {
+    Code.NOT_FOUND: "Proof not found.",
+    Code.UNAVAILABLE: "ProofWiki is unavailable.",
+    Code.ERROR: "The daemon failed to fetch the proof.",
+}
+
+
 class ProofClient:
     def __init__(self, host: str, port: int, timeout: float) -> None:
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.ids = itertools.count(random.getrandbits(31))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.buffer = bytearray(message.MAX_SIZE)
+        self.view = memoryview(self.buffer)
+
+    def __enter__(self) -> "ProofClient":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.sock.close()
+
+    def send(
+        self,
+        msgs: Sequence[Message],
+        write: Optional[Callable[[str], None]] = None,
+    ) -> List[str]:
+        # All messages are sent at once and the replies matched up by id. Late
+        # replies to earlier messages on the same socket are discarded.
+        replies = Replies([msg.request_id for msg in msgs], write)
+        try:
+            for msg in msgs:
+                self.sock.sendto(msg.encode(), (self.host, self.port))
+            deadline = time.monotonic() + self.timeout
+            while not replies.done():
+                self.sock.settimeout(max(0.0, deadline - time.monotonic()))
+                nbytes = self.sock.recv_into(self.buffer)
+                try:
+                    reply = Reply.decode(self.view[:nbytes])
+                except MessageError:
+                    continue
+                # Keep waiting as long as parts keep arriving
+                if replies.add(reply):
+                    deadline = time.monotonic() + self.timeout
+        except socket.timeout as e:
+            raise ClientError("Connection timed out.") from e
+        return replies.get()
+
+    @staticmethod
+    def unpack(reply: Reply) -> Union[str, ClientError]:
+        if reply.code is not Code.OK:
+            return ClientError(ERRORS[reply.code])
+        return str(codec.decompress(reply.payload, reply.codec), "utf-8")
+
+    def query(
+        self,
+        proofs: Sequence[str],
+        fmt: Format = Format.PLAIN,
+        filters: Filters = Filters(),
+        write: Optional[Callable[[str], None]] = None,
+    ) -> List[str]:
+        # Replies to named requests are streamed if they can be written out as
+        # they arrive, random proofs are always ready to send whole
+        method = codec.best()
+        stream = write is not None and len(proofs) > 0
+        if len(proofs) == 0:
+            msgs = [
+                message.random(
+                    getpass.getuser(),
+                    fmt,
+                    method,
+                    next(self.ids),
+                    filters,
+                    stream,
+                ),
+            ]
+        else:
+            msgs = [
+                message.request(proof, fmt, method, next(self.ids), stream)
+                for proof in proofs
+            ]
+        return self.send(msgs, write)
+
+
+class Replies:
+    # Reassembles replies that may come in parts, writing out what has arrived
+    # in request order, separated by blank lines
+    sep: Final = "\n\n"
+
+    def __init__(
+        self,
+        ids: List[Optional[int]],
+        write: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self.ids = ids
+        self.write = write
+        self.parts: Dict[Optional[int], Dict[int, str]] = {i: {} for i in ids}
+        self.nparts: Dict[Optional[int], int] = {}
+        self.results: Dict[Optional[int], Union[str, ClientError]] = {}
+        self.current = 0
+        self.written = 0
+
+    def done(self) -> bool:
+        return len(self.results) == len(self.ids)
+
+    def add(self, reply: Reply) -> bool:
+        request_id = reply.request_id
+        if request_id not in self.parts or request_id in self.results:
+            return False
+        # Unpack right away, the receive buffer is reused for the next reply
+        text = ProofClient.unpack(reply)
+        if isinstance(text, ClientError):
+            self.results[request_id] = text
+            return True
+        parts = self.parts[request_id]
+        part = reply.part if reply.part is not None else 0
+        parts[part] = text
+        if reply.part is None or reply.last:
+            self.nparts[request_id] = part + 1
+        if len(parts) == self.nparts.get(request_id):
+            self.results[request_id] = "".join(parts[idx] for idx in range(len(parts)))
+        self.flush()
+        return True
+
+    def flush(self) -> None:
+        if self.write is None:
+            return
+        while self.current < len(self.ids):
+            request_id = self.ids[self.current]
+            parts = self.parts[request_id]
+            while self.written in parts:
+                if self.written == 0 and self.current > 0:
+                    self.write(Replies.sep)
+                self.write(parts[self.written])
+                self.written += 1
+            if not isinstance(self.results.get(request_id), str):
+                return
+            self.current += 1
+            self.written = 0
+
+    def get(self) -> List[str]:
+        results = [self.results[request_id] for request_id in self.ids]
+        for result in results:
+            if isinstance(result, ClientError):
+                raise result
+        return cast(List[str], results)
+
+
+class ClientCache:
+    # Recently delivered named proofs, so repeated lookups skip the daemon
+    def __init__(self, path: Path, max_entries: int) -> None:
+        self.file = path / consts.CLIENT_CACHE_FILE
+        self.max_entries = max_entries
+        try:
+            self.proofs: Dict[str, str] = json.loads(self.file.read_text())
+        except (OSError, ValueError):
+            self.proofs = {}
+
+    @staticmethod
+    def key(proof: str, fmt: Format) -> str:
+        return f"{fmt.name}:{normalize_title(proof)}"
+
+    def get(self, proof: str, fmt: Format) -> Optional[str]:
+        return self.proofs.get(ClientCache.key(proof, fmt))
+
+    def put(self, proof: str, fmt: Format, text: str) -> None:
+        key = ClientCache.key(proof, fmt)
+        self.proofs.pop(key, None)
+        self.proofs[key] = text
+        for old in list(self.proofs)[: -self.max_entries]:
+            del self.proofs[old]
+
+    def save(self) -> None:
+        try:
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            self.file.write_text(json.dumps(self.proofs))
+        except OSError:
+            pass
+
+
+def parse_endpoint(endpoint: str) -> Optional[Tuple[str, int, int]]:
+    # HOST:PORT:PID, only trusted while that daemon is still alive
+    try:
+        host, port, pid = endpoint.rsplit(":", 2)
+        os.kill(int(pid), 0)
+        return host, int(port), int(pid)
+    except (ValueError, OSError):
+        return None
+
+
+def find_daemon(
+    status_path: Optional[Path],
+    endpoint: Optional[str],
+    shared: bool = False,
+) -> Optional[Tuple[str, int, int]]:
+    if endpoint is not None:
+        daemon = parse_endpoint(endpoint)
+        if daemon is not None:
+            return daemon
+    if status_path is not None:
+        status = Status(status_path).read()
+    elif shared:
+        # Anyone could have written a shared status file somewhere else
+        shared_status = Status(Path(consts.SHARED_DATA_PATH), shared=True)
+        if not shared_status.trusted():
+            return None
+        status = shared_status.read()
+    else:
+        status = Status(Path(consts.DATA_PATH)).read()
+    if status is None:
+        return None
+    return status["host"], status["port"], status["pid"]
+
 
-    def send(self, msg: Message) -> str:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            try:
-                sock.sendto(msg.encode(), (self.host, self.port))
-                sock.settimeout(self.timeout)
-                return sock.recv(4096).decode()
-            except socket.timeout as e:
-                raise ClientError("Connection timed out.") from e
+def launch_daemon(status_path: Optional[Path]) -> Optional[Tuple[str, int, int]]:
+    # Start a daemon on a socket bound here, which exits again once idle
+    path = status_path if status_path is not None else Path(consts.DATA_PATH)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((consts.HOST, 0))
+        fd = sock.fileno()
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "proofaday.daemon_cli",
+                "--quiet",
+                "--status-path",
+                str(path),
+                "start",
+                "--listen-fd",
+                str(fd),
+                "--idle-timeout",
+                str(consts.LAUNCH_IDLE_TIMEOUT),
+            ],
+            pass_fds=[fd],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+    # Another client may have started a daemon first, so use whichever
+    # one wrote the status file
+    status = Status(path)
+    status.wait_for(lambda: status.read() is not None, Status.start_timeout)
+    return find_daemon(path, None)
 
-    def query(self, proof: Optional[str]) -> str:
-        if proof is not None:
-            return self.send(message.request(proof))
-        return self.send(message.random())
 
+def find_ring(status_path: Optional[Path], pid: int) -> Optional[ProofRing]:
+    # Only a daemon run by this user shares proofs through a ring
+    path = status_path if status_path is not None else Path(consts.DATA_PATH)
+    return ProofRing.open(path / consts.RING_FILE, pid)
 
-@click.command(help="Fetch a random proof.")
-@click.argument("proof", required=False, default=None)
+
+@click.command(help="Fetch a random proof, or the named proofs.")
+@click.argument("proofs", nargs=-1)
 @click.option(
     "--status-path",
     help="Directory to place the status file.",
     type=ClickPath(exists=False, file_okay=False),
-    default=consts.DATA_PATH,
+    default=None,
 )
 @click.option(
     "-t",
@@ -53,6 +313,15 @@ class ProofClient:
     default=consts.CLIENT_TIMEOUT,
     show_default=True,
 )
+@click.option(
+    "-f",
+    "--format",
+    "fmt",
+    help="The output format.",
+    type=click.Choice([fmt.name.lower() for fmt in Format]),
+    default=Format.PLAIN.name.lower(),
+    show_default=True,
+)
 @click.option(
     "-o",
     "--output",
@@ -60,21 +329,136 @@ class ProofClient:
     type=click.File("w"),
     default=sys.stdout,
 )
+@click.option(
+    "-w",
+    "--watch",
+    help="Print a new proof every INTERVAL seconds.",
+    metavar="INTERVAL",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+)
+@click.option(
+    "-l",
+    "--max-lines",
+    help="Only show random proofs of at most this many lines.",
+    type=click.IntRange(min=1),
+    default=None,
+)
+@click.option(
+    "--category",
+    help="Only show random proofs from this category.",
+    default=None,
+)
+@click.option(
+    "-u",
+    "--unseen/--any",
+    help="Skip random proofs recently shown to you.",
+    default=False,
+)
+@click.option(
+    "-c",
+    "--cache/--no-cache",
+    help="Reuse recently fetched named proofs.",
+    default=False,
+)
+@click.option(
+    "--endpoint",
+    help=(
+        "Daemon address as HOST:PORT:PID, used instead of reading the status"
+        " file while PID is running."
+    ),
+    envvar=consts.ENDPOINT_VAR,
+    default=None,
+)
+@click.option(
+    "-s",
+    "--shared/--no-shared",
+    help="Use the daemon shared by all users.",
+    default=False,
+)
+@click.option(
+    "--launch/--no-launch",
+    help="Start a daemon that exits when idle if none is running.",
+    default=False,
+)
+@click.option(
+    "--print-endpoint/--no-print-endpoint",
+    help=f"Print the daemon address for use in ${consts.ENDPOINT_VAR}.",
+    default=False,
+)
 def main(
-    proof: Optional[str],
-    status_path: Path,
+    proofs: Sequence[str],
+    status_path: Optional[Path],
     timeout: float,
+    fmt: str,
     output: IO[str],
+    watch: Optional[float],
+    max_lines: Optional[int],
+    category: Optional[str],
+    unseen: bool,
+    cache: bool,
+    endpoint: Optional[str],
+    shared: bool,
+    launch: bool,
+    print_endpoint: bool,
 ) -> None:
-    status = Status(status_path).read()
-    if status is None:
+    daemon = find_daemon(status_path, endpoint, shared)
+    if daemon is None and launch and not shared:
+        daemon = launch_daemon(status_path)
+    if daemon is None:
         sys.exit("Daemon is not running.")
+    host, port, pid = daemon
+    if print_endpoint:
+        click.echo(f"{host}:{port}:{pid}", file=output)
+        return
 
-    client = ProofClient(status["host"], status["port"], timeout)
-    try:
-        click.echo(client.query(proof), file=output)
-    except ClientError as e:
-        sys.exit(str(e))
+    form = Format[fmt.upper()]
+    filters = Filters(max_lines, category, unseen)
+    client_cache = None
+    if cache and len(proofs) > 0:
+        client_cache = ClientCache(Path(consts.CACHE_PATH), consts.NCLIENT_CACHE)
+        cached = [client_cache.get(proof, form) for proof in proofs]
+        if all(text is not None for text in cached):
+            click.echo("\n\n".join(str(text) for text in cached), file=output)
+            return
+
+    def write(text: str) -> None:
+        output.write(text)
+        output.flush()
+
+    # Take unfiltered random proofs straight from the daemon's ring, falling
+    # back to asking it once the ring is empty
+    ring = None
+    if len(proofs) == 0 and filters == Filters() and not shared:
+        ring = find_ring(status_path, pid)
+
+    with ProofClient(host, port, timeout) as client:
+        try:
+            while True:
+                taken = ring.take(form) if ring is not None else None
+                if taken is not None:
+                    replies = [str(taken, "utf-8")]
+                    write(replies[0])
+                else:
+                    replies = client.query(proofs, form, filters, write)
+                click.echo(file=output)
+                if watch is None:
+                    break
+                output.flush()
+                time.sleep(watch)
+                click.echo(file=output)
+        except ClientError as e:
+            sys.exit(str(e))
+        except KeyboardInterrupt:
+            return
+        finally:
+            if ring is not None:
+                ring.close()
+
+    if client_cache is not None:
+        for proof, text in zip(proofs, replies):
+            client_cache.put(proof, form, text)
+        client_cache.save()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+import copy
+import json
+import sys
+import zlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from proofaday import codec
+from proofaday.cache import normalize_title
+from proofaday.codec import Codec
+from proofaday.message import Format
+from proofaday.proof import Proof
+
+ANSI_BOLD = "\033[1m"
+ANSI_RESET = "\033[0m"
+
+
+def head(fmt: Format, title: str, theorem: str) -> str:
+    # Everything up to the proof, for formats that can be streamed. The
+    # theorem is given as LaTeX for the LaTeX format.
+    underline = "=" * len(title)
+    # pylint: disable=no-else-return
+    if fmt in (Format.PLAIN, Format.LATEX):
+        return f"{title}\n{underline}\n{theorem}\n\nProof:\n"
+    elif fmt is Format.ANSI:
+        return (
+            f"{ANSI_BOLD}{title}{ANSI_RESET}\n{underline}\n"
+            f"{theorem}\n\n{ANSI_BOLD}Proof:{ANSI_RESET}\n"
+        )
+    raise ValueError(f"Format {fmt} can't be streamed")
+
+
+class Record:
+    # A proof with its output formats rendered once. The LaTeX source is only
+    # needed for some formats, so it is kept compressed.
+    __slots__ = (
+        "title",
+        "theorem",
+        "proof",
+        "latex",
+        "revision",
+        "categories",
+        "lines",
+        "size",
+        "renders",
+    )
+
+    def __init__(
+        self,
+        title: str,
+        theorem: str,
+        proof: str,
+        raw_theorem: str,
+        raw_proof: str,
+        revision: Optional[int] = None,
+        categories: Sequence[str] = (),
+        prerender: bool = True,
+    ) -> None:
+        self.title = sys.intern(title)
+        self.theorem = theorem
+        self.proof = proof
+        self.latex = zlib.compress(f"{raw_theorem}\0{raw_proof}".encode())
+        self.revision = revision
+        self.categories = tuple(
+            sys.intern(normalize_title(category)) for category in categories
+        )
+        plain = self.format(Format.PLAIN).encode()
+        self.lines = plain.count(b"\n") + 1
+        self.size = len(plain)
+        self.renders: Dict[Tuple[Format, Codec], Tuple[Codec, bytes]] = {}
+        if prerender:
+            for fmt in Format:
+                for method in codec.COMPRESS:
+                    self.render(fmt, method)
+
+    @property
+    def raw(self) -> Tuple[str, str]:
+        theorem, proof = zlib.decompress(self.latex).decode().split("\0", 1)
+        return theorem, proof
+
+    def nbytes(self) -> int:
+        # The memory held by the record, its text and its renders
+        texts = (self.title, self.theorem, self.proof, self.latex)
+        renders = [data for _, data in self.renders.values()]
+        size = sys.getsizeof(self) + sys.getsizeof(self.renders)
+        return size + sum(sys.getsizeof(data) for data in (*texts, *renders))
+
+    def compact(self) -> "Record":
+        # A copy sharing the text but not the renders, which are filled in
+        # again as they are requested
+        record = copy.copy(self)
+        record.renders = {}
+        return record
+
+    @staticmethod
+    def from_proof(proof: Proof, revision: Optional[int] = None) -> "Record":
+        # pylint: disable=protected-access
+        return Record(
+            proof.title,
+            proof.theorem,
+            proof.proof,
+            proof._theorem,
+            proof._proof,
+            revision,
+            proof.categories,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        raw_theorem, raw_proof = self.raw
+        return {
+            "title": self.title,
+            "theorem": self.theorem,
+            "proof": self.proof,
+            "raw_theorem": raw_theorem,
+            "raw_proof": raw_proof,
+            "revision": self.revision,
+            "categories": list(self.categories),
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> "Record":
+        return Record(
+            data["title"],
+            data["theorem"],
+            data["proof"],
+            data["raw_theorem"],
+            data["raw_proof"],
+            data.get("revision"),
+            data.get("categories", ()),
+            prerender=False,
+        )
+
+    def text(self, fmt: Format) -> Tuple[str, str]:
+        # The theorem and proof as shown in a format
+        if fmt is Format.LATEX:
+            return self.raw
+        return self.theorem, self.proof
+
+    def format(self, fmt: Format) -> str:
+        if fmt is Format.JSON:
+            raw_theorem, raw_proof = self.raw
+            return json.dumps(
+                {
+                    "title": self.title,
+                    "theorem": self.theorem,
+                    "proof": self.proof,
+                    "latex": {"theorem": raw_theorem, "proof": raw_proof},
+                },
+                ensure_ascii=False,
+            )
+        theorem, proof = self.text(fmt)
+        return head(fmt, self.title, theorem) + proof
+
+    def parts(self, fmt: Format, size: int) -> List[str]:
+        # The text up to the proof, then the proof in chunks of at most size
+        # characters
+        if fmt is Format.JSON:
+            return [self.format(fmt)]
+        theorem, proof = self.text(fmt)
+        chunks = [proof[idx : idx + size] for idx in range(0, len(proof), size)]
+        return [head(fmt, self.title, theorem), *chunks]
+
+    def render(
+        self,
+        fmt: Format,
+        method: Codec = Codec.NONE,
+    ) -> Tuple[Codec, bytes]:
+        if method is not Codec.NONE:
+            method = codec.negotiate(method)
+        render = self.renders.get((fmt, method))
+        if render is None:
+            data = self.format(fmt).encode()
+            render = self.renders[fmt, method] = codec.compress(data, method)
+        return render
@@ -0,0 +1,151 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Sequence
+
+from typing_extensions import Final
+
+from proofaday.message import Format
+
+
+class ProofRing:
+    # Prefetched proofs shared with local clients through a memory mapped
+    # file. Each slot holds one proof rendered in every format. Slots are
+    # claimed under a lock on the first byte of the file, so a proof is only
+    # ever taken by one reader. The file lock is held by the whole process,
+    # so threads take turns holding it.
+    magic: Final = b"PADRING1"
+    header: Final = struct.Struct("!8sIII")
+    slot_header: Final = struct.Struct("!B" + "I" * len(Format))
+    empty: Final = 0
+    full: Final = 1
+    file_mode: Final = 0o600
+
+    def __init__(self, file: Path, fd: int, nslots: int, slot_size: int) -> None:
+        self.file = file
+        self.fd = fd
+        self.nslots = nslots
+        self.slot_size = slot_size
+        self.thread_lock = threading.Lock()
+        self.map = mmap.mmap(fd, ProofRing.size(nslots, slot_size))
+
+    @staticmethod
+    def size(nslots: int, slot_size: int) -> int:
+        return ProofRing.header.size + nslots * slot_size
+
+    @staticmethod
+    def create(file: Path, nslots: int, slot_size: int) -> "ProofRing":
+        # Fill in a temporary file first so readers never map a partial ring
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_name(f"{file.name}.{os.getpid()}.tmp")
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, ProofRing.file_mode)
+        try:
+            os.ftruncate(fd, ProofRing.size(nslots, slot_size))
+            ring = ProofRing(file, fd, nslots, slot_size)
+            ProofRing.header.pack_into(
+                ring.map,
+                0,
+                ProofRing.magic,
+                os.getpid(),
+                nslots,
+                slot_size,
+            )
+            os.replace(tmp, file)
+            return ring
+        except BaseException:
+            os.close(fd)
+            os.unlink(tmp)
+            raise
+
+    @staticmethod
+    def open(file: Path, pid: int) -> Optional["ProofRing"]:
+        # Only use the ring of the running daemon, not one left behind
+        try:
+            fd = os.open(file, os.O_RDWR)
+        except OSError:
+            return None
+        try:
+            data = os.read(fd, ProofRing.header.size)
+            magic, owner, nslots, slot_size = ProofRing.header.unpack(data)
+            size = ProofRing.size(nslots, slot_size)
+            valid = magic == ProofRing.magic and owner == pid
+            if valid and os.fstat(fd).st_size == size:
+                return ProofRing(file, fd, nslots, slot_size)
+        except (OSError, ValueError, struct.error):
+            pass
+        os.close(fd)
+        return None
+
+    def offsets(self) -> Iterator[int]:
+        for idx in range(self.nslots):
+            yield ProofRing.header.size + idx * self.slot_size
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        with self.thread_lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+
+    def fits(self, renders: Sequence[bytes]) -> bool:
+        size = ProofRing.slot_header.size + sum(len(render) for render in renders)
+        return size <= self.slot_size
+
+    def put(self, renders: Sequence[bytes]) -> bool:
+        # Renders are given in format order
+        if not self.fits(renders):
+            return False
+        with self.locked():
+            for offset in self.offsets():
+                if self.map[offset] != ProofRing.empty:
+                    continue
+                start = offset + ProofRing.slot_header.size
+                for render in renders:
+                    self.map[start : start + len(render)] = render
+                    start += len(render)
+                lengths = [len(render) for render in renders]
+                ProofRing.slot_header.pack_into(
+                    self.map,
+                    offset,
+                    ProofRing.empty,
+                    *lengths,
+                )
+                # Only mark the slot full once everything else is written
+                self.map[offset] = ProofRing.full
+                return True
+            return False
+
+    def take(self, fmt: Format) -> Optional[bytes]:
+        with self.locked():
+            for offset in self.offsets():
+                if self.map[offset] != ProofRing.full:
+                    continue
+                _, *lengths = ProofRing.slot_header.unpack_from(self.map, offset)
+                start = offset + ProofRing.slot_header.size + sum(lengths[:fmt])
+                data = self.map[start : start + lengths[fmt]]
+                self.map[offset] = ProofRing.empty
+                return data
+            return None
+
+    def count(self) -> int:
+        with self.locked():
+            return sum(self.map[offset] == ProofRing.full for offset in self.offsets())
+
+    def close(self) -> None:
+        self.map.close()
+        os.close(self.fd)
+
+    def remove(self) -> None:
+        # Only remove the file if it is still this ring's
+        try:
+            if os.stat(self.file).st_ino == os.fstat(self.fd).st_ino:
+                self.file.unlink()
+        except OSError:
+            pass
+        self.close()
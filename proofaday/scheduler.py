@@ -0,0 +1,251 @@
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from queue import Empty
+from typing import Callable, Deque, Dict, Generic, List, Optional, TypeVar
+
+from typing_extensions import Final
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class FairQueue(Generic[T]):
+    # A bounded queue that hands items to waiting clients in least recently
+    # served order, so one busy client can't starve the others. The memory
+    # held by queued items is tracked if they can be measured.
+    max_clients: Final = 1024
+
+    def __init__(self, maxsize: int, size: Optional[Callable[[T], int]] = None) -> None:
+        self.maxsize = maxsize
+        self.size = size
+        self.nbytes = 0
+        self.items: Deque[T] = deque()
+        self.sizes: Deque[int] = deque()
+        self.cond = threading.Condition()
+        self.waiting: Dict[str, int] = {}
+        self.served: "OrderedDict[str, float]" = OrderedDict()
+
+    def qsize(self) -> int:
+        with self.cond:
+            return len(self.items)
+
+    def drain(self) -> List[T]:
+        with self.cond:
+            items = list(self.items)
+            self.items.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+            self.cond.notify_all()
+            return items
+
+    def put(self, item: T) -> None:
+        with self.cond:
+            while len(self.items) >= self.maxsize:
+                self.cond.wait()
+            self.items.append(item)
+            self.sizes.append(self.size(item) if self.size is not None else 0)
+            self.nbytes += self.sizes[-1]
+            self.cond.notify_all()
+
+    def _turn(self, client: str) -> bool:
+        nxt = min(self.waiting, key=lambda c: self.served.get(c, 0.0))
+        return self.served.get(client, 0.0) <= self.served.get(nxt, 0.0)
+
+    def get(self, client: str, timeout: Optional[float] = None) -> T:
+        with self.cond:
+            self.waiting[client] = self.waiting.get(client, 0) + 1
+            try:
+                if not self.cond.wait_for(
+                    lambda: len(self.items) > 0 and self._turn(client),
+                    timeout=timeout,
+                ):
+                    raise Empty
+                self.served.pop(client, None)
+                self.served[client] = time.monotonic()
+                while len(self.served) > FairQueue.max_clients:
+                    self.served.popitem(last=False)
+                self.nbytes -= self.sizes.popleft()
+                return self.items.popleft()
+            finally:
+                self.waiting[client] -= 1
+                if self.waiting[client] == 0:
+                    del self.waiting[client]
+                self.cond.notify_all()
+
+
+class Backoff:
+    def __init__(self, base: float, cap: float) -> None:
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+    def next(self) -> float:
+        # Exponential backoff with full jitter
+        delay = min(self.cap, self.base * 2**self.attempts)
+        self.attempts += 1
+        return random.uniform(0, delay)
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = 0.0
+
+    @property
+    def open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def remaining(self) -> float:
+        # Time until a trial request is allowed through
+        if not self.open:
+            return 0.0
+        return max(0.0, self.opened + self.cooldown - time.monotonic())
+
+    def success(self) -> None:
+        self.failures = 0
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = time.monotonic()
+
+
+class LatencyTracker:
+    def __init__(self, window: int) -> None:
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def percentile(self, q: float) -> float:
+        if len(self.samples) == 0:
+            raise ValueError("No samples")
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HedgeBudget:
+    # Each request earns a fraction of an extra request, so hedging adds at
+    # most that fraction to the load
+    def __init__(self, ratio: float, burst: int) -> None:
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = float(burst)
+
+    def earn(self) -> None:
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Scheduler:
+    rate: Final = 2.0
+    burst: Final = 5
+    backoff_base: Final = 0.5
+    backoff_cap: Final = 60.0
+    failure_threshold: Final = 5
+    cooldown: Final = 30.0
+    latency_window: Final = 50
+    default_timeout: Final = 1.0
+    min_timeout: Final = 0.5
+    max_timeout: Final = 10.0
+    timeout_factor: Final = 3.0
+    hedge_ratio: Final = 0.1
+    hedge_burst: Final = 3
+    min_hedge_delay: Final = 0.1
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(Scheduler.rate, Scheduler.burst)
+        self.backoff = Backoff(Scheduler.backoff_base, Scheduler.backoff_cap)
+        self.breaker = CircuitBreaker(Scheduler.failure_threshold, Scheduler.cooldown)
+        self.latency = LatencyTracker(Scheduler.latency_window)
+        self.hedges = HedgeBudget(Scheduler.hedge_ratio, Scheduler.hedge_burst)
+        self.delay_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        with self.lock:
+            return not self.breaker.open
+
+    @property
+    def timeout(self) -> float:
+        with self.lock:
+            try:
+                timeout = Scheduler.timeout_factor * self.latency.percentile(0.9)
+            except ValueError:
+                return Scheduler.default_timeout
+        return min(Scheduler.max_timeout, max(Scheduler.min_timeout, timeout))
+
+    def hedge_delay(self) -> Optional[float]:
+        # How long to wait on a request before sending a duplicate, if enough
+        # is known about the latency
+        with self.lock:
+            self.hedges.earn()
+            try:
+                delay = self.latency.percentile(0.9)
+            except ValueError:
+                return None
+        return max(Scheduler.min_hedge_delay, delay)
+
+    def hedge(self) -> bool:
+        with self.lock:
+            return not self.breaker.open and self.hedges.spend()
+
+    def acquire(self) -> None:
+        self.bucket.acquire()
+
+    def allow(self) -> bool:
+        with self.lock:
+            return self.breaker.remaining() == 0
+
+    def delay(self) -> float:
+        with self.lock:
+            backoff = self.delay_until - time.monotonic()
+            return max(0.0, backoff, self.breaker.remaining())
+
+    def success(self, latency: float) -> None:
+        with self.lock:
+            self.latency.record(latency)
+            self.breaker.success()
+            self.backoff.reset()
+            self.delay_until = 0.0
+
+    def failure(self) -> None:
+        with self.lock:
+            self.breaker.failure()
+            self.delay_until = time.monotonic() + self.backoff.next()
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import struct
+import zlib
+from typing import IO, Any, Dict, Iterable, Iterator
+
+from typing_extensions import Final
+
+# A snapshot is a magic string and version, followed by a zlib stream of
+# length prefixed JSON entries. A zero length ends the entries and is followed
+# by their count and a SHA-256 digest of everything before it in the stream.
+MAGIC: Final = b"PADSNAP"
+VERSION: Final = 1
+HEADER: Final = struct.Struct("!7sB")
+LENGTH: Final = struct.Struct("!I")
+TRAILER: Final = struct.Struct("!Q32s")
+CHUNK_SIZE: Final = 64 * 1024
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write(out: IO[bytes], entries: Iterable[Dict[str, Any]]) -> int:
+    out.write(HEADER.pack(MAGIC, VERSION))
+    compressor = zlib.compressobj()
+    digest = hashlib.sha256()
+    count = 0
+    for entry in entries:
+        data = json.dumps(entry, ensure_ascii=False).encode()
+        frame = LENGTH.pack(len(data)) + data
+        digest.update(frame)
+        out.write(compressor.compress(frame))
+        count += 1
+    end = LENGTH.pack(0)
+    digest.update(end)
+    out.write(compressor.compress(end + TRAILER.pack(count, digest.digest())))
+    out.write(compressor.flush())
+    return count
+
+
+class Reader:
+    # Decompresses a snapshot a chunk at a time, so that reading one takes
+    # the same memory whatever its size
+    def __init__(self, src: IO[bytes]) -> None:
+        self.src = src
+        self.decompressor = zlib.decompressobj()
+        self.buffer = bytearray()
+        self.digest = hashlib.sha256()
+
+    def read(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            chunk = self.src.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                self.buffer += self.decompressor.flush()
+                if len(self.buffer) < size:
+                    raise SnapshotError("Snapshot is truncated.")
+                break
+            try:
+                self.buffer += self.decompressor.decompress(chunk)
+            except zlib.error as e:
+                raise SnapshotError("Snapshot is corrupt.") from e
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def frame(self) -> bytes:
+        prefix = self.read(LENGTH.size)
+        self.digest.update(prefix)
+        (length,) = LENGTH.unpack(prefix)
+        data = self.read(length)
+        self.digest.update(data)
+        return data
+
+
+def read(src: IO[bytes]) -> Iterator[Dict[str, Any]]:
+    # Entries are only trustworthy once the whole snapshot has been read
+    # without raising
+    magic, version = HEADER.unpack(src.read(HEADER.size).ljust(HEADER.size, b"\0"))
+    if magic != MAGIC:
+        raise SnapshotError("Not a snapshot.")
+    if version != VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {version}.")
+    reader = Reader(src)
+    count = 0
+    while True:
+        data = reader.frame()
+        if len(data) == 0:
+            break
+        try:
+            yield json.loads(data)
+        except ValueError as e:
+            raise SnapshotError("Snapshot is corrupt.") from e
+        count += 1
+    expected = reader.digest.digest()
+    ncount, digest = TRAILER.unpack(reader.read(TRAILER.size))
+    if ncount != count or digest != expected:
+        raise SnapshotError("Snapshot checksum doesn't match.")
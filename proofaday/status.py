@@ -1,45 +1,155 @@
 import json
+import os
+import stat
 import threading
 import time
 from pathlib import Path
-from typing import Any, Iterable, Optional
+from typing import AbstractSet, Any, Callable, Iterable, Optional
 
 from typing_extensions import Final, Literal, TypedDict
 
 import proofaday.constants as consts
 
-StatusData = TypedDict("StatusData", {"pid": int, "host": str, "port": int})
-Key = Literal["pid", "host", "port"]
-
-KEYS: Final[Iterable[Key]] = ["pid", "host", "port"]
+StatusData = TypedDict(
+    "StatusData",
+    {
+        "pid": int,
+        "host": str,
+        "port": int,
+        "ready": bool,
+        "queued": int,
+        "capacity": int,
+        "fetched": int,
+        "rejected": int,
+        "skipped": int,
+        "hedges": int,
+        "hedge_wins": int,
+        "hedge_losses": int,
+        "memory": int,
+        "max_memory": int,
+    },
+)
+Key = Literal[
+    "pid",
+    "host",
+    "port",
+    "ready",
+    "queued",
+    "capacity",
+    "fetched",
+    "rejected",
+    "skipped",
+    "hedges",
+    "hedge_wins",
+    "hedge_losses",
+    "memory",
+    "max_memory",
+]
+
+KEYS: Final[Iterable[Key]] = [
+    "pid",
+    "host",
+    "port",
+    "ready",
+    "queued",
+    "capacity",
+    "fetched",
+    "rejected",
+    "skipped",
+    "hedges",
+    "hedge_wins",
+    "hedge_losses",
+    "memory",
+    "max_memory",
+]
 
 
 class StatusError(Exception):
     pass
 
 
+def trusted_dir(path: Path, owners: AbstractSet[int]) -> bool:
+    # Only trust a directory, and the ones above it, if it belongs to one of
+    # owners and no one else can add or replace files in it
+    try:
+        parent = path.parent.resolve(strict=True)
+        for info in [os.lstat(path)] + [os.stat(p) for p in (parent, *parent.parents)]:
+            if not stat.S_ISDIR(info.st_mode) or info.st_uid not in owners:
+                return False
+            if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                return False
+        return True
+    except OSError:
+        return False
+
+
+def shared_dir(path: Path) -> bool:
+    # A shared daemon runs as root or a user of its own
+    try:
+        path.mkdir(mode=Status.dir_mode, parents=True, exist_ok=True)
+    except OSError:
+        return False
+    return trusted_dir(path, {0, os.geteuid()})
+
+
 class Status:
     poll_interval: Final = 0.5
-
-    def __init__(self, path: Path) -> None:
+    start_timeout: Final = 5.0
+    # A daemon exits within its shutdown timeout, usually much sooner
+    stop_poll: Final = 0.01
+    stop_timeout: Final = 3.0
+    # Readable by every user so that a shared daemon can be discovered
+    dir_mode: Final = 0o755
+    file_mode: Final = 0o644
+
+    def __init__(self, path: Path, shared: bool = False) -> None:
         self.file = path / consts.STATUS_FILE
+        self.shared = shared
 
     def touch(self) -> bool:
         try:
-            self.file.parent.mkdir(parents=True, exist_ok=True)
-            self.file.touch(exist_ok=False)
+            self.file.parent.mkdir(
+                mode=Status.dir_mode,
+                parents=True,
+                exist_ok=True,
+            )
+            self.file.touch(mode=Status.file_mode, exist_ok=False)
             return True
         except OSError:
             return False
 
+    def trusted(self) -> bool:
+        # Clients only use a shared daemon's status file if its owner, or
+        # root, is the only one who could have written it
+        try:
+            info = os.lstat(self.file)
+        except OSError:
+            return False
+        if not stat.S_ISREG(info.st_mode):
+            return False
+        if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return False
+        return trusted_dir(self.file.parent, {0, info.st_uid})
+
     def read(self) -> Optional[StatusData]:
-        if self.file.is_file():
+        # The file is empty until the daemon first writes it
+        try:
             return json.loads(self.file.read_text())  # type: ignore[no-any-return]
-        return None
+        except (OSError, ValueError):
+            return None
+
+    def queued(self) -> int:
+        # Older daemons don't publish their queue, so count them as cold
+        data = self.read()
+        return data.get("queued", 0) if data is not None else 0
 
     def write(self, **kwargs: Any) -> bool:
+        # Write atomically so readers never see a partial file
+        tmp = self.file.with_name(f"{self.file.name}.{os.getpid()}.tmp")
         try:
-            self.file.write_text(json.dumps(kwargs))
+            tmp.write_text(json.dumps(kwargs))
+            tmp.chmod(Status.file_mode)
+            os.replace(tmp, self.file)
             return True
         except OSError:
             return False
@@ -51,24 +161,49 @@ class Status:
         except OSError:
             return False
 
-    def _wait(self, exist: bool, stop: threading.Event) -> None:
-        while self.file.is_file() != exist and not stop.is_set():
-            time.sleep(Status.poll_interval)
-
-    def wait(self, exist: bool, timeout: Optional[float] = 1.5) -> bool:
+    @staticmethod
+    def _wait(done: Callable[[], bool], stop: threading.Event, interval: float) -> None:
+        while not done() and not stop.is_set():
+            time.sleep(interval)
+
+    def wait_for(
+        self,
+        done: Callable[[], bool],
+        timeout: Optional[float],
+        interval: float = poll_interval,
+    ) -> bool:
         stop = threading.Event()
         wait_thread = threading.Thread(
-            target=self._wait,
-            args=(exist, stop),
+            target=Status._wait,
+            args=(done, stop, interval),
             daemon=True,
         )
         wait_thread.start()
         wait_thread.join(timeout=timeout)
         stop.set()
-        return self.file.is_file() == exist
+        return done()
+
+    def wait(
+        self,
+        exist: bool,
+        timeout: Optional[float] = 1.5,
+        interval: float = poll_interval,
+    ) -> bool:
+        return self.wait_for(lambda: self.file.is_file() == exist, timeout, interval)
+
+    def wait_warm(self, nproofs: int, timeout: Optional[float] = None) -> bool:
+        # Give up early if the daemon stops
+        self.wait_for(
+            lambda: not self.file.is_file() or self.queued() >= nproofs,
+            timeout,
+        )
+        return self.queued() >= nproofs
 
     def __str__(self) -> str:
         data = self.read()
         if data is None:
             raise ValueError
-        return "\n".join(f"{k}={data[k]}" for k in KEYS)
+        lines = [f"{k}={data[k]}" for k in KEYS if k in data]
+        if data.get("fetched"):
+            lines.append(f"rejection_ratio={data['rejected'] / data['fetched']:.2f}")
+        return "\n".join(lines)
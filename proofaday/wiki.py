@@ -0,0 +1,88 @@
+from enum import Enum
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+import requests
+
+import proofaday.constants as consts
+
+
+class Source(Enum):
+    HTML = "html"
+    API = "api"
+    WIKITEXT = "wikitext"
+
+
+class Page(NamedTuple):
+    title: str
+    revision: int
+    content: Optional[str] = None
+    categories: Tuple[str, ...] = ()
+
+
+def render_url(title: str) -> str:
+    # Only the rendered page content, without the surrounding skin
+    return f"{consts.INDEX_URL}?title={quote(title.replace(' ', '_'))}&action=render"
+
+
+def query(params: Dict[str, str], timeout: float) -> Any:
+    resp = requests.get(
+        consts.API_URL,
+        params={**params, "action": "query", "format": "json", "formatversion": "2"},
+        timeout=timeout,
+    )
+    resp.raise_for_status()
+    return resp.json()["query"]
+
+
+def page_props(content: bool) -> Dict[str, str]:
+    # Rendered pages leave out the category links, so ask for them here
+    if not content:
+        return {"prop": "info|categories", "cllimit": "max"}
+    return {"prop": "revisions", "rvprop": "content|ids", "rvslots": "main"}
+
+
+def to_page(data: Any) -> Optional[Page]:
+    if "revisions" in data:
+        rev = data["revisions"][0]
+        return Page(data["title"], rev["revid"], rev["slots"]["main"]["content"])
+    if "lastrevid" in data:
+        categories = tuple(
+            category["title"].split(":", 1)[-1]
+            for category in data.get("categories", [])
+        )
+        return Page(data["title"], data["lastrevid"], categories=categories)
+    return None
+
+
+def random_pages(n: int, timeout: float, content: bool = False) -> List[Page]:
+    data = query(
+        {
+            "generator": "random",
+            "grnnamespace": "0",
+            "grnfilterredir": "nonredirects",
+            "grnlimit": str(n),
+            **page_props(content),
+        },
+        timeout,
+    )
+    pages = (to_page(page) for page in data["pages"])
+    return [page for page in pages if page is not None]
+
+
+def revisions(titles: List[str], timeout: float) -> Dict[str, Optional[int]]:
+    data = query(
+        {"titles": "|".join(titles), "redirects": "1", "prop": "info"},
+        timeout,
+    )
+    revs = {page["title"]: page.get("lastrevid") for page in data["pages"]}
+    # Map the titles we asked for onto the pages they resolved to
+    for alias in data.get("redirects", []) + data.get("normalized", []):
+        if alias["to"] in revs:
+            revs[alias["from"]] = revs[alias["to"]]
+    return revs
+
+
+def resolve(title: str, timeout: float, content: bool = False) -> Optional[Page]:
+    data = query({"titles": title, "redirects": "1", **page_props(content)}, timeout)
+    return to_page(data["pages"][0])